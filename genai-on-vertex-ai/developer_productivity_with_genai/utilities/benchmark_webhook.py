@@ -0,0 +1,338 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays recorded webhook payloads against stubbed components.
+
+The LLM and the retrievers of the webhook are replaced with stubs that sleep
+for a configurable time, so the harness measures the webhook's own overhead
+plus the simulated stage latencies, and reports p50/p95 per span recorded
+by `webhook_tracing`.
+
+Usage:
+    python benchmark_webhook.py payloads.jsonl --repeat 20 \\
+        --llm-latency 0.8 --routing-latency 0.3 --retriever-latency 0.2
+
+With `--asgi`, requests are sent to `webhook_asgi.app` in process with up to
+`--concurrency` requests in flight, and the throughput and the number of
+deadline fallbacks and coalesced requests are reported as well:
+    python benchmark_webhook.py --asgi --concurrency 50 --repeat 200 --unique-queries
+
+Add `--stream` to either mode to request server-sent events and report the
+time to the first answer token.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import re
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.llms.base import LLM
+from langchain.schema import BaseRetriever, Document
+
+import webhook_tracing
+from retrieval_cache import RetrievalCache
+
+SAMPLE_PAYLOAD = {
+    "detectIntentResponseId": "benchmark",
+    "fulfillmentInfo": {"tag": "get-rag"},
+    "text": "How does the transaction history service paginate results?",
+}
+
+
+class StubLLM(LLM):
+    """Answers router prompts with a fixed destination and a canned answer.
+
+    Like `VertexAI`, the answer tokens are only reported to the callbacks when
+    `streaming` is set.
+    """
+
+    latency: float = 0.5
+    streaming: bool = False
+    routing_latency: float = 0.2
+    destination: str = "codebase search"
+    answer: str = "This is a stubbed answer generated for benchmarking the webhook."
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        if "<< CANDIDATE PROMPTS >>" in prompt:
+            time.sleep(self.routing_latency)
+            return self._route(prompt)
+
+        tokens = self.answer.split(" ")
+        for token in tokens:
+            time.sleep(self.latency / len(tokens))
+            if run_manager and self.streaming:
+                run_manager.on_llm_new_token(token + " ")
+        return self.answer
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        # Like the Vertex AI async client, waits without holding a thread
+        if "<< CANDIDATE PROMPTS >>" in prompt:
+            await asyncio.sleep(self.routing_latency)
+            return self._route(prompt)
+
+        tokens = self.answer.split(" ")
+        for token in tokens:
+            await asyncio.sleep(self.latency / len(tokens))
+            if run_manager and self.streaming:
+                await run_manager.on_llm_new_token(token + " ")
+        return self.answer
+
+    def _route(self, prompt: str) -> str:
+        match = re.search(r"<< INPUT >>\s*(.*?)\s*<< OUTPUT", prompt, re.S)
+        next_inputs = match.group(1) if match else ""
+        return "```json\n" + json.dumps({"destination": self.destination, "next_inputs": next_inputs}) + "\n```"
+
+
+class StubRetriever(BaseRetriever):
+    latency: float = 0.1
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        time.sleep(self.latency)
+        return [Document(page_content=f"stub document {i} for: {query}") for i in range(3)]
+
+
+class RecordedRequest:
+    """Minimal stand-in for `flask.Request`."""
+
+    def __init__(self, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        self.payload = payload
+        self.headers = headers or {}
+
+    def get_json(self, silent: bool = False):
+        return self.payload
+
+
+def load_payloads(path: Optional[str]) -> List[Dict[str, Any]]:
+    """Reads payloads from a JSONL file or a directory of JSON files."""
+    if not path:
+        return [SAMPLE_PAYLOAD]
+    if os.path.isdir(path):
+        payloads = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".json"):
+                with open(os.path.join(path, name)) as f:
+                    payloads.append(json.load(f))
+        return payloads
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    values = sorted(values)
+    # Nearest-rank percentile
+    rank = max(0, min(len(values) - 1, math.ceil(pct / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def summarize(durations: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    return {
+        name: {
+            "count": len(values),
+            "mean_ms": round(sum(values) / len(values), 3),
+            "p50_ms": round(percentile(values, 50), 3),
+            "p95_ms": round(percentile(values, 95), 3),
+        }
+        for name, values in sorted(durations.items())
+    }
+
+
+def patch_webhook(webhook, args) -> None:
+    """Swaps the webhook's component builders for latency stubs.
+
+    The retrieval caches start empty; with `--no-cache` they are replaced by
+    pass-through caches so every request pays the retriever latency.
+    """
+    for name, cache in list(webhook.retrieval_caches.items()):
+        if args.no_cache:
+            webhook.retrieval_caches[name] = RetrievalCache(ttl=0, max_bytes=0)
+        else:
+            cache.clear()
+
+    def build_code_retriever():
+        with webhook_tracing.trace_span("me_endpoint_discovery"):
+            time.sleep(args.setup_latency)
+        return StubRetriever(latency=args.retriever_latency, metadata={"retriever": "codebase search"})
+
+    webhook.build_llm = lambda streaming=False: StubLLM(
+        latency=args.llm_latency, routing_latency=args.routing_latency, destination=args.destination,
+        streaming=streaming,
+    )
+    webhook.build_code_retriever = build_code_retriever
+    webhook.build_search_retriever = lambda search_engine_id, name: StubRetriever(
+        latency=args.retriever_latency, metadata={"retriever": name}
+    )
+
+
+def run_benchmark(webhook, payloads, repeat: int, stream: bool) -> Dict[str, Any]:
+    durations = defaultdict(list)
+    webhook_tracing.span_listeners.append(lambda span: durations[span["span"]].append(span["duration_ms"]))
+    headers = {"Accept": "text/event-stream"} if stream else {}
+    first_token = []
+
+    for _ in range(repeat):
+        for payload in payloads:
+            start = time.perf_counter()
+            response = webhook.hello_world(RecordedRequest(payload, headers))
+            if stream and hasattr(response, "response"):
+                # Drain the server-sent events like a client would
+                for i, _ in enumerate(response.response):
+                    if i == 0:
+                        first_token.append((time.perf_counter() - start) * 1000)
+            durations["end_to_end"].append((time.perf_counter() - start) * 1000)
+
+    if first_token:
+        durations["time_to_first_event"] = first_token
+    return summarize(durations)
+
+
+def run_asgi_benchmark(asgi, payloads, repeat: int, concurrency: int, unique_queries: bool, stream: bool):
+    """Sends repeat x payloads requests to `asgi.app` with up to concurrency in flight."""
+    durations = defaultdict(list)
+    webhook_tracing.span_listeners.append(lambda span: durations[span["span"]].append(span["duration_ms"]))
+    fallbacks = []
+    headers = [(b"content-type", b"application/json")]
+    if stream:
+        headers.append((b"accept", b"text/event-stream"))
+
+    async def call(payload):
+        body = json.dumps(payload).encode("UTF-8")
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        messages = []
+        first_token = []
+
+        async def send(message):
+            messages.append(message)
+            if not first_token and b"event: token" in message.get("body", b""):
+                first_token.append((time.perf_counter() - start) * 1000)
+
+        scope = {"type": "http", "method": "POST", "path": "/", "headers": headers}
+        start = time.perf_counter()
+        await asgi.app(scope, receive, send)
+        durations["end_to_end"].append((time.perf_counter() - start) * 1000)
+        if first_token:
+            durations["time_to_first_token"] += first_token
+        if asgi.FALLBACK_ANSWER.encode("UTF-8") in b"".join(m.get("body", b"") for m in messages):
+            fallbacks.append(payload)
+
+    async def run_all():
+        asgi.startup()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(payload):
+            async with semaphore:
+                await call(payload)
+
+        requests = []
+        for i in range(repeat):
+            for payload in payloads:
+                if unique_queries:
+                    payload = dict(payload, text=f"{payload.get('text', '')} ({i})")
+                requests.append(bounded(payload))
+        start = time.perf_counter()
+        await asyncio.gather(*requests)
+        return time.perf_counter() - start
+
+    seconds = asyncio.run(run_all())
+    requests = repeat * len(payloads)
+    totals = {
+        "requests": requests,
+        "seconds": round(seconds, 3),
+        "requests_per_second": round(requests / seconds, 1),
+        "fallbacks": len(fallbacks),
+        "chain_runs": asgi.inflight_queries.started,
+        "coalesced": asgi.inflight_queries.coalesced,
+    }
+    return summarize(durations), totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("payloads", nargs="?", help="JSONL file or directory of recorded payloads.")
+    parser.add_argument("--module", default="webhook_cloud_function", help="Module defining hello_world.")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--stream", action="store_true", help="Request server-sent events.")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--routing-latency", type=float, default=0.2)
+    parser.add_argument("--retriever-latency", type=float, default=0.1)
+    parser.add_argument("--setup-latency", type=float, default=0.0)
+    parser.add_argument("--destination", default="codebase search")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Bypass the retrieval caches so repeated payloads measure retriever latency.")
+    parser.add_argument("--asgi", action="store_true", help="Benchmark webhook_asgi.app instead of hello_world.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight with --asgi.")
+    parser.add_argument("--deadline", type=float, help="Override WEBHOOK_DEADLINE_SECONDS with --asgi.")
+    parser.add_argument("--unique-queries", action="store_true", help="Make every request's text distinct.")
+    parser.add_argument("--output", help="Write the summary as JSON to this path.")
+    args = parser.parse_args()
+
+    webhook_tracing.LOG_SPANS = False
+    webhook = importlib.import_module(args.module)
+    patch_webhook(webhook, args)
+    payloads = load_payloads(args.payloads)
+    totals = None
+    if args.asgi:
+        asgi = importlib.import_module("webhook_asgi")
+        if args.deadline is not None:
+            asgi.WEBHOOK_DEADLINE_SECONDS = args.deadline
+        summary, totals = run_asgi_benchmark(
+            asgi, payloads, args.repeat, args.concurrency, args.unique_queries, args.stream)
+    else:
+        summary = run_benchmark(webhook, payloads, args.repeat, args.stream)
+
+    print(f"{'span':<40}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}")
+    for name, stats in summary.items():
+        print(f"{name:<40}{stats['count']:>8}{stats['p50_ms']:>12.1f}{stats['p95_ms']:>12.1f}")
+    if totals:
+        print(json.dumps(totals))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"spans": summary, "totals": totals} if totals else summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
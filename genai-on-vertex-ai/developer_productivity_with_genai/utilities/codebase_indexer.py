@@ -0,0 +1,439 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental indexer for the codebase search retriever.
+
+Walks a repository, compares each file's content hash with the manifest
+written by the previous run and only re-chunks, re-embeds and upserts the
+files that changed; datapoints of deleted files and of chunks that no longer
+exist are removed. Files flow through a load -> split -> embed -> upsert
+pipeline with a bounded number of files in flight.
+
+Usage:
+    python codebase_indexer.py ./bank-of-anthos --manifest manifest.json \\
+        --local-index /tmp/me-local-index --fake-embeddings
+    python codebase_indexer.py ./bank-of-anthos --manifest manifest.json \\
+        --project <project> --region us-central1 --index-id <id> --bucket <bucket>
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 200
+MAX_FILE_BYTES = 1024 * 1024
+UPSERT_BATCH_SIZE = 100
+SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv"}
+# Same quota as the webhook's `CustomVertexAIEmbeddings`
+EMBEDDING_QPM = 100
+EMBEDDING_NUM_BATCH = 5
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def datapoint_id(rel_path: str, chunk: int) -> str:
+    """Stable id so a re-indexed chunk overwrites its previous datapoint."""
+    return f"{hashlib.sha1(rel_path.encode('UTF-8')).hexdigest()}-{chunk}"
+
+
+def walk_repository(
+    repo_dir: str, extensions: Optional[Sequence[str]] = None
+) -> Iterator[str]:
+    """Yields repository-relative paths of candidate source files."""
+    for root, dirs, files in os.walk(repo_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(files):
+            if extensions and not name.endswith(tuple(extensions)):
+                continue
+            path = os.path.join(root, name)
+            if os.path.getsize(path) > MAX_FILE_BYTES:
+                continue
+            yield os.path.relpath(path, repo_dir)
+
+
+@dataclass
+class IndexStats:
+    files_seen: int = 0
+    files_changed: int = 0
+    files_deleted: int = 0
+    files_skipped: int = 0
+    datapoints_upserted: int = 0
+    datapoints_removed: int = 0
+
+
+@dataclass
+class FileChunks:
+    rel_path: str
+    content_hash: str
+    ids: List[str] = field(default_factory=list)
+    texts: List[str] = field(default_factory=list)
+    embeddings: List[List[float]] = field(default_factory=list)
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """Spaces the embedding requests of all worker threads to stay under a per-minute quota.
+
+    Unlike `CustomVertexAIEmbeddings` in the webhook, whose limiter only spaces
+    the batches of one call, the limiter here is shared by concurrent calls.
+    """
+
+    def __init__(self, embedding: Embeddings, requests_per_minute: int, num_instances_per_batch: int):
+        self.embedding = embedding
+        self.period = 60 / requests_per_minute
+        self.num_instances_per_batch = num_instances_per_batch
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+    def _wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_request)
+            self._next_request = slot + self.period
+        if slot > now:
+            time.sleep(slot - now)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        results = []
+        for start in range(0, len(texts), self.num_instances_per_batch):
+            self._wait()
+            results += self.embedding.embed_documents(texts[start : start + self.num_instances_per_batch])
+        return results
+
+    def embed_query(self, text: str) -> List[float]:
+        self._wait()
+        return self.embedding.embed_query(text)
+
+
+class LocalIndexSink:
+    """Stand-in for a streaming Matching Engine index.
+
+    Keeps the datapoints in the export layout read by
+    `local_matching_engine.LocalMatchingEngine` (`indexes/local/index.json`
+    and `documents/<id>` under export_dir), so the result can be served and
+    queried without any Google Cloud resources. Rebuild the local index
+    (`LocalMatchingEngine.from_components(..., rebuild=True)`) after a run.
+
+    Flushed datapoints are appended to `index.json`, so a batch costs its own
+    size rather than the size of the index; only the vectors of the pending
+    batch are held in memory. Overwritten records are dropped by `close`,
+    removed ones when the removal is flushed.
+    """
+
+    def __init__(self, export_dir: str):
+        self.export_dir = export_dir
+        self.index_path = os.path.join(export_dir, "indexes", "local", "index.json")
+        self.documents_dir = os.path.join(export_dir, "documents")
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        os.makedirs(self.documents_dir, exist_ok=True)
+        self._pending: Dict[str, np.ndarray] = {}
+        self._removed = set()
+        self._written = set()
+        self._superseded = False
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    if line.strip():
+                        self._add_written(json.loads(line)["id"])
+
+    def _add_written(self, doc_id: str) -> None:
+        self._superseded |= doc_id in self._written
+        self._written.add(doc_id)
+
+    def upsert(self, ids: List[str], texts: List[str], embeddings: List[List[float]]) -> None:
+        for doc_id, text, embedding in zip(ids, texts, embeddings):
+            self._pending[doc_id] = np.asarray(embedding, dtype=np.float32)
+            self._removed.discard(doc_id)
+            with open(os.path.join(self.documents_dir, doc_id), "w") as f:
+                f.write(text)
+
+    def remove(self, ids: List[str]) -> None:
+        for doc_id in ids:
+            self._pending.pop(doc_id, None)
+            if doc_id in self._written:
+                self._removed.add(doc_id)
+            path = os.path.join(self.documents_dir, doc_id)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def flush(self) -> None:
+        if self._removed:
+            self._compact()
+        if self._pending:
+            lines = []
+            for doc_id, embedding in self._pending.items():
+                self._add_written(doc_id)
+                lines.append(json.dumps({"id": doc_id, "embedding": embedding.tolist()}) + "\n")
+            with open(self.index_path, "a") as f:
+                f.write("".join(lines))
+            self._pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+        if self._superseded:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Rewrites index.json with the last record of each id that was not removed."""
+        last_line = {}
+        with open(self.index_path) as f:
+            for number, line in enumerate(f):
+                if line.strip():
+                    last_line[json.loads(line)["id"]] = number
+        keep = {number for doc_id, number in last_line.items() if doc_id not in self._removed}
+        tmp_path = self.index_path + ".tmp"
+        with open(self.index_path) as f, open(tmp_path, "w") as out:
+            for number, line in enumerate(f):
+                if number in keep:
+                    out.write(line)
+        os.replace(tmp_path, self.index_path)
+        self._written -= self._removed
+        self._removed.clear()
+        self._superseded = False
+
+
+class MatchingEngineIndexSink:
+    """Upserts and removes datapoints of a streaming Matching Engine index.
+
+    Chunk texts are written to `gs://<bucket>/documents/<id>`, where
+    `MatchingEngine.similarity_search` reads them back.
+    """
+
+    def __init__(self, project_id: str, region: str, index_id: str, gcs_bucket_name: str):
+        from google.cloud import aiplatform, storage
+
+        aiplatform.init(project=project_id, location=region)
+        self.index = aiplatform.MatchingEngineIndex(index_name=index_id)
+        self.bucket = storage.Client(project=project_id).bucket(gcs_bucket_name)
+
+    def upsert(self, ids: List[str], texts: List[str], embeddings: List[List[float]]) -> None:
+        from google.cloud.aiplatform_v1.types import IndexDatapoint
+
+        for doc_id, text in zip(ids, texts):
+            self.bucket.blob(f"documents/{doc_id}").upload_from_string(text)
+        self.index.upsert_datapoints(
+            datapoints=[
+                IndexDatapoint(datapoint_id=doc_id, feature_vector=embedding)
+                for doc_id, embedding in zip(ids, embeddings)
+            ]
+        )
+
+    def remove(self, ids: List[str]) -> None:
+        self.index.remove_datapoints(datapoint_ids=ids)
+        for doc_id in ids:
+            blob = self.bucket.blob(f"documents/{doc_id}")
+            if blob.exists():
+                blob.delete()
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class CodebaseIndexer:
+    """Keeps an index in sync with a repository using a content-hash manifest.
+
+    The manifest maps each indexed file to its content hash and datapoint
+    ids. It is saved after every upsert batch, so an interrupted run resumes
+    from the files that were not written yet.
+    """
+
+    def __init__(
+        self,
+        repo_dir: str,
+        manifest_path: str,
+        sink,
+        embedding: Embeddings,
+        extensions: Optional[Sequence[str]] = None,
+        max_workers: int = 4,
+        max_files_in_flight: int = 16,
+        upsert_batch_size: int = UPSERT_BATCH_SIZE,
+    ):
+        self.repo_dir = repo_dir
+        self.manifest_path = manifest_path
+        self.sink = sink
+        self.embedding = embedding
+        self.extensions = extensions
+        self.max_workers = max_workers
+        self.max_files_in_flight = max(max_files_in_flight, max_workers)
+        self.upsert_batch_size = upsert_batch_size
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+        )
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self) -> Dict[str, dict]:
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {}
+
+    def _save_manifest(self) -> None:
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _changed_files(self, stats: IndexStats, seen: set) -> Iterator[tuple]:
+        for rel_path in walk_repository(self.repo_dir, self.extensions):
+            stats.files_seen += 1
+            seen.add(rel_path)
+            content_hash = file_hash(os.path.join(self.repo_dir, rel_path))
+            entry = self.manifest.get(rel_path)
+            if entry and entry["hash"] == content_hash:
+                continue
+            yield rel_path, content_hash
+
+    def _process_file(self, rel_path: str, content_hash: str) -> Optional[FileChunks]:
+        """Load, split and embed one file. Runs on the worker pool."""
+        try:
+            with open(os.path.join(self.repo_dir, rel_path), encoding="UTF-8") as f:
+                text = f.read()
+        except UnicodeDecodeError:
+            return None
+        chunks = FileChunks(rel_path, content_hash)
+        chunks.texts = [t for t in self.splitter.split_text(text) if t.strip()]
+        chunks.ids = [datapoint_id(rel_path, i) for i in range(len(chunks.texts))]
+        if chunks.texts:
+            chunks.embeddings = self.embedding.embed_documents(chunks.texts)
+        return chunks
+
+    def _process_changed(self, changed: Iterator[tuple]) -> Iterator[tuple]:
+        """Runs `_process_file` on the pool, keeping a bounded window of files in flight."""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = []
+            for rel_path, content_hash in changed:
+                pending.append((rel_path, pool.submit(self._process_file, rel_path, content_hash)))
+                if len(pending) >= self.max_files_in_flight:
+                    rel_path, future = pending.pop(0)
+                    yield rel_path, future.result()
+            for rel_path, future in pending:
+                yield rel_path, future.result()
+
+    def run(self) -> IndexStats:
+        stats = IndexStats()
+        seen = set()
+        batch = []
+        batch_size = 0
+
+        def write_batch():
+            ids, texts, embeddings, stale = [], [], [], []
+            for chunks in batch:
+                ids += chunks.ids
+                texts += chunks.texts
+                embeddings += chunks.embeddings
+                current = set(chunks.ids)
+                previous = self.manifest.get(chunks.rel_path, {}).get("ids", [])
+                stale += [i for i in previous if i not in current]
+            if ids:
+                self.sink.upsert(ids, texts, embeddings)
+            if stale:
+                self.sink.remove(stale)
+            self.sink.flush()
+            for chunks in batch:
+                self.manifest[chunks.rel_path] = {"hash": chunks.content_hash, "ids": chunks.ids}
+            self._save_manifest()
+            stats.datapoints_upserted += len(ids)
+            stats.datapoints_removed += len(stale)
+
+        for rel_path, chunks in self._process_changed(self._changed_files(stats, seen)):
+            if chunks is None:
+                # No longer text: drop whatever was indexed for it like a deleted file
+                seen.discard(rel_path)
+                stats.files_skipped += 1
+                continue
+            stats.files_changed += 1
+            batch.append(chunks)
+            batch_size += len(chunks.ids)
+            if batch_size >= self.upsert_batch_size:
+                write_batch()
+                batch, batch_size = [], 0
+        if batch:
+            write_batch()
+
+        deleted = [path for path in self.manifest if path not in seen]
+        if deleted:
+            stale = [i for path in deleted for i in self.manifest[path]["ids"]]
+            if stale:
+                self.sink.remove(stale)
+            self.sink.flush()
+            for path in deleted:
+                del self.manifest[path]
+            self._save_manifest()
+            stats.files_deleted += len(deleted)
+            stats.datapoints_removed += len(stale)
+        self.sink.close()
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("repo_dir")
+    parser.add_argument("--manifest", required=True, help="Path of the content-hash manifest.")
+    parser.add_argument("--extensions", nargs="*", help="Only index files with these suffixes.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--embedding-qpm", type=int, default=EMBEDDING_QPM,
+                        help="Embedding API requests per minute, shared by all workers.")
+    parser.add_argument("--local-index", help="Export directory of a local stand-in index.")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use random embeddings instead of the Vertex AI API.")
+    parser.add_argument("--project")
+    parser.add_argument("--region", default="us-central1")
+    parser.add_argument("--index-id")
+    parser.add_argument("--bucket")
+    args = parser.parse_args()
+
+    if args.local_index:
+        sink = LocalIndexSink(os.path.join(args.local_index, "export"))
+    elif args.project and args.index_id and args.bucket:
+        sink = MatchingEngineIndexSink(args.project, args.region, args.index_id, args.bucket)
+    else:
+        parser.error("either --local-index or --project, --index-id and --bucket are required")
+
+    if args.fake_embeddings:
+        from langchain.embeddings import FakeEmbeddings
+        embedding = FakeEmbeddings(size=768)
+    else:
+        from langchain.embeddings import VertexAIEmbeddings
+        embedding = RateLimitedEmbeddings(VertexAIEmbeddings(), args.embedding_qpm, EMBEDDING_NUM_BATCH)
+
+    indexer = CodebaseIndexer(
+        args.repo_dir, args.manifest, sink, embedding,
+        extensions=args.extensions, max_workers=args.workers,
+    )
+    print(indexer.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-in for the Matching Engine vector store.
+
+Loads the embeddings that `MatchingEngine.add_texts` exports to the
+`ME_EMBEDDING_DIR` bucket (`init_index/*.json`, `indexes/*/index.json` and
+`documents/<id>`), stores them as a memory-mapped float32 matrix and serves
+top-k dot-product search from an IVF (inverted file) index, so the code
+retriever can run without a deployed index endpoint.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import uuid
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+from langchain.schema import Document
+from langchain.vectorstores.base import VectorStore
+
+# Below this many vectors a brute force matmul is already a few milliseconds,
+# so no coarse quantizer is trained.
+EXACT_SEARCH_MAX_VECTORS = 20000
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 256
+# Caps the in-memory training sample (~200 MB of 768-dimensional vectors)
+KMEANS_MAX_SAMPLES = 64 * 1024
+ASSIGN_BATCH_SIZE = 8192
+# Parallel blob downloads when copying the export from Cloud Storage
+DOWNLOAD_WORKERS = 32
+
+EXPORT_PREFIXES = ("init_index/", "indexes/")
+DOCUMENTS_PREFIX = "documents/"
+
+VECTORS_FILE = "vectors.npy"
+EXPORT_VECTORS_FILE = "export_vectors.npy"
+IDS_FILE = "ids.json"
+CENTROIDS_FILE = "centroids.npy"
+OFFSETS_FILE = "list_offsets.npy"
+
+
+def _export_records(paths: List[str]) -> Iterator[dict]:
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def read_embedding_export(export_dir: str, vectors_path: str) -> Tuple[List[str], np.ndarray]:
+    """Reads every `{"id": ..., "embedding": [...]}` JSON line below export_dir.
+
+    Later files win when the same id appears more than once, matching the
+    upsert semantics of the streaming index. The vectors are streamed into a
+    float32 matrix memory-mapped from vectors_path, so the export is never
+    held in memory as Python lists.
+    """
+    paths = _export_files(export_dir)
+    rows: Dict[str, int] = {}
+    dimensions = 0
+    for record in _export_records(paths):
+        rows.setdefault(record["id"], len(rows))
+        dimensions = dimensions or len(record["embedding"])
+    if not rows:
+        raise FileNotFoundError(f"No embeddings found in {export_dir}")
+
+    vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(len(rows), dimensions))
+    for record in _export_records(paths):
+        vectors[rows[record["id"]]] = record["embedding"]
+    vectors.flush()
+    return list(rows), vectors
+
+
+def _export_files(export_dir: str) -> List[str]:
+    # The initial export comes before the upsert batches, whatever their names sort as
+    prefix_order = [prefix.rstrip("/") for prefix in EXPORT_PREFIXES]
+
+    def order(path: str) -> Tuple[int, str]:
+        top = os.path.relpath(path, export_dir).split(os.sep)[0]
+        rank = prefix_order.index(top) if top in prefix_order else len(prefix_order)
+        return rank, path
+
+    paths = [
+        os.path.join(root, name)
+        for root, _, files in os.walk(export_dir)
+        for name in files
+        if name.endswith(".json")
+    ]
+    return sorted(paths, key=order)
+
+
+def download_export(gcs_bucket_name: str, local_dir: str) -> None:
+    """Copies the embedding export and the document texts to local_dir."""
+    from google.cloud import storage
+    from google.cloud.storage import transfer_manager
+
+    bucket = storage.Client().bucket(gcs_bucket_name)
+    blob_names = [
+        blob.name
+        for prefix in EXPORT_PREFIXES + (DOCUMENTS_PREFIX,)
+        for blob in bucket.list_blobs(prefix=prefix)
+        if not blob.name.endswith("/")
+    ]
+    transfer_manager.download_many_to_path(
+        bucket,
+        blob_names,
+        destination_directory=os.path.join(local_dir, "export"),
+        # Threads: the blobs are small and the client is not forked or pickled
+        worker_type=transfer_manager.THREAD,
+        max_workers=DOWNLOAD_WORKERS,
+        raise_exception=True,
+    )
+
+
+def _train_centroids(vectors: np.ndarray, n_lists: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists, len(vectors))
+    n_samples = min(len(vectors), n_lists * KMEANS_SAMPLES_PER_LIST, max(KMEANS_MAX_SAMPLES, n_lists))
+    # Sorted so a memory-mapped matrix is read front to back
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), n_samples, replace=False))])
+    centroids = sample[rng.choice(n_samples, n_lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=n_lists)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = np.asarray(vectors[start : start + ASSIGN_BATCH_SIZE])
+        assignment[start : start + len(batch)] = np.argmax(
+            batch @ centroids.T - half_norms, axis=1
+        )
+    return assignment
+
+
+def _write_vectors(path: str, vectors: np.ndarray, order: Optional[np.ndarray]) -> None:
+    # Copied in batches so a memory-mapped input is never loaded as a whole
+    tmp_path = path + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=vectors.shape)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        rows = slice(start, start + ASSIGN_BATCH_SIZE)
+        out[rows] = vectors[rows] if order is None else vectors[order[rows]]
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+
+class LocalVectorIndex:
+    """Memory-mapped dot-product index with an optional IVF coarse quantizer.
+
+    Vectors are stored grouped by inverted list so a probe reads one
+    contiguous slice of the matrix per list.
+    """
+
+    def __init__(
+        self,
+        ids: List[str],
+        vectors: np.ndarray,
+        centroids: Optional[np.ndarray] = None,
+        list_offsets: Optional[np.ndarray] = None,
+        nprobe: int = 8,
+    ):
+        self.ids = ids
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.nprobe = nprobe
+
+    @property
+    def is_exact(self) -> bool:
+        return self.centroids is None
+
+    @classmethod
+    def build(
+        cls,
+        ids: List[str],
+        vectors: np.ndarray,
+        index_dir: str,
+        n_lists: Optional[int] = None,
+        nprobe: int = 8,
+    ) -> "LocalVectorIndex":
+        """Trains the quantizer, writes the index to index_dir and loads it."""
+        os.makedirs(index_dir, exist_ok=True)
+        # No copy for the float32 matrix memory-mapped by `read_embedding_export`
+        vectors = np.asarray(vectors, dtype=np.float32)
+        order = None
+        if n_lists is None:
+            n_lists = 0 if len(vectors) <= EXACT_SEARCH_MAX_VECTORS else int(np.sqrt(len(vectors)))
+        # Each list needs at least one vector to seed its centroid
+        n_lists = min(n_lists, len(vectors))
+
+        if n_lists > 1:
+            centroids = _train_centroids(vectors, n_lists)
+            assignment = _assign(vectors, centroids)
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=n_lists)
+            offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            ids = [ids[i] for i in order]
+            np.save(os.path.join(index_dir, CENTROIDS_FILE), centroids)
+            np.save(os.path.join(index_dir, OFFSETS_FILE), offsets)
+        else:
+            for name in (CENTROIDS_FILE, OFFSETS_FILE):
+                if os.path.exists(os.path.join(index_dir, name)):
+                    os.remove(os.path.join(index_dir, name))
+
+        _write_vectors(os.path.join(index_dir, VECTORS_FILE), vectors, order)
+        with open(os.path.join(index_dir, IDS_FILE), "w") as f:
+            json.dump(list(ids), f)
+        return cls.load(index_dir, nprobe=nprobe)
+
+    @classmethod
+    def load(cls, index_dir: str, nprobe: int = 8) -> "LocalVectorIndex":
+        vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode="r")
+        with open(os.path.join(index_dir, IDS_FILE)) as f:
+            ids = json.load(f)
+        centroids = list_offsets = None
+        if os.path.exists(os.path.join(index_dir, CENTROIDS_FILE)):
+            centroids = np.load(os.path.join(index_dir, CENTROIDS_FILE))
+            list_offsets = np.load(os.path.join(index_dir, OFFSETS_FILE))
+        return cls(ids, vectors, centroids, list_offsets, nprobe=nprobe)
+
+    @staticmethod
+    def exists(index_dir: str) -> bool:
+        return os.path.exists(os.path.join(index_dir, VECTORS_FILE))
+
+    def search(self, query: List[float], k: int) -> List[Tuple[str, float]]:
+        """Returns up to k (id, dot product) pairs, highest score first."""
+        query = np.asarray(query, dtype=np.float32)
+        if self.is_exact:
+            rows = np.arange(len(self.ids))
+            scores = np.asarray(self.vectors) @ query
+        else:
+            nprobe = min(self.nprobe, len(self.centroids))
+            probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.concatenate(
+                [np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in probed]
+            )
+            if not len(rows):
+                return []
+            scores = np.concatenate(
+                [
+                    self.vectors[self.list_offsets[i] : self.list_offsets[i + 1]] @ query
+                    for i in probed
+                ]
+            )
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+
+class LocalMatchingEngine(VectorStore):
+    """Drop-in replacement for `MatchingEngine` backed by `LocalVectorIndex`.
+
+    `similarity_search` keeps the Matching Engine semantics: `k` neighbours
+    are fetched and only those with a dot product of at least
+    `search_distance` are returned.
+    """
+
+    def __init__(self, index: LocalVectorIndex, embedding: Embeddings, documents_dir: str):
+        self.index = index
+        self.embedding = embedding
+        self.documents_dir = documents_dir
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    @classmethod
+    def from_components(
+        cls,
+        index_dir: str,
+        embedding: Embeddings,
+        gcs_bucket_name: Optional[str] = None,
+        n_lists: Optional[int] = None,
+        nprobe: int = 8,
+        rebuild: bool = False,
+    ) -> "LocalMatchingEngine":
+        """Loads the index in index_dir, building it from the export if needed.
+
+        Args:
+            index_dir: Local working directory, e.g. under /tmp on Cloud Functions.
+            embedding: Embeddings used for queries; must match the export.
+            gcs_bucket_name: Bucket holding the Matching Engine export. When
+                omitted, the export is expected in `<index_dir>/export`.
+            n_lists: Number of IVF lists. Defaults to exact search for small
+                exports and sqrt(n) lists otherwise.
+            nprobe: Number of IVF lists scanned per query.
+            rebuild: Rebuild the index even if one exists in index_dir.
+        """
+        export_dir = os.path.join(index_dir, "export")
+        if rebuild or not LocalVectorIndex.exists(index_dir):
+            if gcs_bucket_name:
+                download_export(gcs_bucket_name, index_dir)
+            export_vectors_path = os.path.join(index_dir, EXPORT_VECTORS_FILE)
+            ids, vectors = read_embedding_export(export_dir, export_vectors_path)
+            index = LocalVectorIndex.build(ids, vectors, index_dir, n_lists=n_lists, nprobe=nprobe)
+            del vectors
+            os.remove(export_vectors_path)
+        else:
+            index = LocalVectorIndex.load(index_dir, nprobe=nprobe)
+        return cls(index, embedding, os.path.join(export_dir, DOCUMENTS_PREFIX))
+
+    def _read_document(self, doc_id: str) -> Optional[str]:
+        path = os.path.join(self.documents_dir, doc_id)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, search_distance: float = 0.65
+    ) -> List[Tuple[Document, float]]:
+        results = []
+        for doc_id, distance in self.index.search(embedding, k):
+            if distance < search_distance:
+                continue
+            page_content = self._read_document(doc_id)
+            if page_content is None:
+                continue
+            results.append((Document(page_content=page_content, metadata={"id": doc_id}), distance))
+        return results
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, search_distance: float = 0.65, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embedding.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, search_distance)
+
+    def similarity_search(
+        self, query: str, k: int = 4, search_distance: float = 0.65, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, search_distance)]
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any
+    ) -> List[str]:
+        raise NotImplementedError(
+            "LocalMatchingEngine is read-only; add texts with MatchingEngine and rebuild the local index."
+        )
+
+    @classmethod
+    def from_texts(
+        cls: Type["LocalMatchingEngine"],
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        index_dir: str = "",
+        **kwargs: Any,
+    ) -> "LocalMatchingEngine":
+        """Embeds texts and writes them in the Matching Engine export layout."""
+        if not index_dir:
+            raise ValueError("index_dir is required.")
+        export_dir = os.path.join(index_dir, "export")
+        documents_dir = os.path.join(export_dir, DOCUMENTS_PREFIX)
+        os.makedirs(documents_dir, exist_ok=True)
+        os.makedirs(os.path.join(export_dir, "init_index"), exist_ok=True)
+
+        texts = list(texts)
+        ids = [str(uuid.uuid4()) for _ in texts]
+        vectors = embedding.embed_documents(texts)
+        with open(os.path.join(export_dir, "init_index", "embeddings_0.json"), "w") as f:
+            for doc_id, text, vector in zip(ids, texts, vectors):
+                f.write(json.dumps({"id": doc_id, "embedding": list(vector)}) + "\n")
+                with open(os.path.join(documents_dir, doc_id), "w") as doc:
+                    doc.write(text)
+        return cls.from_components(index_dir, embedding, rebuild=True, **kwargs)
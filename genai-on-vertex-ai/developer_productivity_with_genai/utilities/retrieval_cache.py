@@ -0,0 +1,169 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Result cache for the webhook's retrievers.
+
+`RetrievalCache` is an LRU cache bounded by the byte size of the cached
+documents. Entries are fresh for `ttl` seconds; for a further `stale_ttl`
+seconds they are still served while a background thread refreshes them
+(stale-while-revalidate). `CachedRetriever` wraps any LangChain retriever
+with one of these caches, keyed on the normalized query and the retriever's
+search parameters.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Tuple
+
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+
+from webhook_tracing import trace_span
+
+# Retriever attributes that change the result set for the same query
+KEY_ATTRIBUTES = ("search_type", "search_kwargs", "max_documents", "search_engine_id", "filter")
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def document_bytes(doc: Document) -> int:
+    return len(doc.page_content.encode("UTF-8")) + len(json.dumps(doc.metadata, default=str))
+
+
+def cache_key(retriever: BaseRetriever, query: str) -> Tuple[str, str]:
+    params = {
+        name: getattr(retriever, name)
+        for name in KEY_ATTRIBUTES
+        if getattr(retriever, name, None) is not None
+    }
+    return normalize_query(query), json.dumps(params, sort_keys=True, default=str)
+
+
+class RetrievalCache:
+    def __init__(self, ttl: float, stale_ttl: float = 0, max_bytes: int = 16 * 1024 * 1024):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.hits = self.stale_hits = self.misses = 0
+        self._entries = OrderedDict()  # key -> (documents, size, fetched_at)
+        self._bytes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, key, fetch: Callable[[bool], List[Document]]) -> List[Document]:
+        """Returns the cached documents for key.
+
+        fetch is called with `refresh=False` on a miss and with
+        `refresh=True` from the background thread refreshing a stale entry.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                documents, _, fetched_at = entry
+                age = now - fetched_at
+                if age < self.ttl:
+                    self.hits += 1
+                    return list(documents)
+                if age < self.ttl + self.stale_ttl:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        context = contextvars.copy_context()
+                        threading.Thread(
+                            target=context.run, args=(self._refresh, key, fetch), daemon=True
+                        ).start()
+                    return list(documents)
+            self.misses += 1
+
+        documents = fetch(False)
+        self.put(key, documents)
+        return list(documents)
+
+    def _refresh(self, key, fetch: Callable[[bool], List[Document]]) -> None:
+        try:
+            self.put(key, fetch(True))
+        except Exception as e:
+            # Keep serving the stale entry until it expires
+            print(f"Background refresh of retrieval cache failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def put(self, key, documents: List[Document]) -> None:
+        size = sum(document_bytes(doc) for doc in documents)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (list(documents), size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class CachedRetriever(BaseRetriever):
+    """Serves `retriever` results through `cache`.
+
+    The inner retriever is called without the chain's callbacks so that a
+    cache hit and a miss produce the same retriever span; misses and
+    background refreshes are timed as `retriever_fetch` spans instead.
+    """
+
+    retriever: BaseRetriever
+    cache: Any
+    source: str = ""
+
+    def _fetch(self, query: str, refresh: bool) -> List[Document]:
+        with trace_span("retriever_fetch", source=self.source, refresh=refresh):
+            return self.retriever.get_relevant_documents(query)
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        key = cache_key(self.retriever, query)
+        return self.cache.get(key, lambda refresh: self._fetch(query, refresh))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # Cache hits return at once; misses block on the retriever's client,
+        # so the lookup runs in the loop's executor with the request context.
+        context = contextvars.copy_context()
+        lookup = functools.partial(self._get_relevant_documents, query, run_manager=run_manager)
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, lookup)
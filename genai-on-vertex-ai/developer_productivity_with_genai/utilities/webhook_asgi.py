@@ -0,0 +1,351 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""ASGI serving mode for the Dialogflow webhook.
+
+`app` answers the same requests as `webhook_cloud_function.hello_world`, but
+runs the RAG chain with `Chain.acall` on one event loop, so a single instance
+serves many conversation turns at once instead of blocking on each:
+
+- LLM calls are awaited and blocking retriever lookups run in a thread pool,
+  so the stages of concurrent requests overlap.
+- The LLM and retrievers are built once per instance and shared.
+- Identical questions in flight at the same time are coalesced into one chain
+  execution, for JSON and server-sent event requests alike.
+- A JSON request still waiting after `WEBHOOK_DEADLINE_SECONDS` (or that
+  fails) gets a fallback answer before Dialogflow's webhook timeout. A
+  timed-out run keeps going, and the same session asking the same question
+  again within `LATE_RESULT_TTL_SECONDS` gets its answer.
+- Server-sent event requests are not held to the Dialogflow deadline: they
+  get answer tokens as they are generated, with keep-alive comments while
+  none arrive.
+
+Run with any ASGI server, e.g. on Cloud Run:
+    uvicorn webhook_asgi:app --host 0.0.0.0 --port $PORT
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import webhook_cloud_function as webhook
+from retrieval_cache import normalize_query
+from webhook_tracing import trace_span, traced_async_stream, traced_async_webhook
+
+# Dialogflow CX gives up on a webhook after 5 seconds by default (configurable
+# up to 30 seconds per webhook); answer a little before that.
+WEBHOOK_DEADLINE_SECONDS = float(os.environ.get("WEBHOOK_DEADLINE_SECONDS", "4.5"))
+# How long a session that got the fallback can pick up the run's answer
+LATE_RESULT_TTL_SECONDS = 120
+# Comment sent on an idle event stream so proxies keep the connection open
+SSE_KEEPALIVE_SECONDS = 2.0
+SSE_KEEPALIVE = ": keep-alive\n\n"
+# Threads for blocking retriever clients; sized for I/O-bound waits, not CPUs
+WORKER_THREADS = int(os.environ.get("WEBHOOK_WORKER_THREADS", "64"))
+
+FALLBACK_ANSWER = "I'm still looking into that. Please ask me again in a moment."
+
+
+class AnswerRun:
+    """One chain execution whose answer tokens several requests can follow."""
+
+    def __init__(self):
+        self.tokens = []
+        self.task: Optional[asyncio.Task] = None
+        self._new_token = asyncio.Event()
+
+    def put(self, token: str) -> None:
+        # Called by `AnswerStreamHandler`, inline on the event loop
+        self.tokens.append(token)
+        self._new_token.set()
+
+    def failed(self) -> bool:
+        return self.task.done() and (self.task.cancelled() or self.task.exception() is not None)
+
+    async def follow(self):
+        """Yields the answer tokens from the first one until the run finishes."""
+        sent = 0
+        while True:
+            while sent < len(self.tokens):
+                yield self.tokens[sent]
+                sent += 1
+            if self.task.done():
+                return
+            self._new_token.clear()
+            waiter = asyncio.ensure_future(self._new_token.wait())
+            try:
+                await asyncio.wait({waiter, self.task}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+
+
+class InflightQueries:
+    """Coalesces identical questions in flight at the same time into one chain execution.
+
+    A run is dropped as soon as it finishes. A run that a request gave up on at
+    its deadline is kept for that request's session only (see `defer`), so the
+    session's next identical question gets the answer instead of a new run.
+    """
+
+    def __init__(self, late_result_ttl: float):
+        self.late_result_ttl = late_result_ttl
+        self.started = self.coalesced = self.late_results = 0
+        self._runs: Dict[str, AnswerRun] = {}
+        self._deferred: Dict[str, Tuple[str, AnswerRun]] = {}
+
+    def __len__(self):
+        return len(self._runs)
+
+    def submit(self, query: str, start: Callable[[str, AnswerRun], Awaitable[str]],
+               session: Optional[str] = None) -> Tuple[AnswerRun, bool]:
+        """Returns the run answering query and whether another request started it."""
+        key = normalize_query(query)
+        deferred = self._deferred.pop(session, None) if session else None
+        if deferred is not None and deferred[0] == key and not deferred[1].failed():
+            self.late_results += 1
+            return deferred[1], True
+
+        run = self._runs.get(key)
+        if run is not None:
+            self.coalesced += 1
+            return run, True
+        self.started += 1
+        run = AnswerRun()
+        run.task = asyncio.get_running_loop().create_task(start(query, run))
+        self._runs[key] = run
+        run.task.add_done_callback(lambda _: self._finished(key, run))
+        return run, False
+
+    def defer(self, session: Optional[str], query: str, run: AnswerRun) -> None:
+        """Keeps run for the next identical question of session, for `late_result_ttl` seconds."""
+        if not session:
+            return
+        self._deferred[session] = (normalize_query(query), run)
+        asyncio.get_running_loop().call_later(self.late_result_ttl, self._expire, session, run)
+
+    def _finished(self, key: str, run: AnswerRun) -> None:
+        if self._runs.get(key) is run:
+            del self._runs[key]
+        if not run.task.cancelled():
+            # Marks the error as retrieved when no request is waiting any more
+            run.task.exception()
+
+    def _expire(self, session: str, run: AnswerRun) -> None:
+        if session in self._deferred and self._deferred[session][1] is run:
+            del self._deferred[session]
+
+
+inflight_queries = InflightQueries(late_result_ttl=LATE_RESULT_TTL_SECONDS)
+
+# Built on first use and shared by all requests of the instance
+_components = None
+_components_lock = asyncio.Lock()
+
+
+async def get_components():
+    global _components
+    if _components is None:
+        async with _components_lock:
+            if _components is None:
+                with trace_span("setup"):
+                    # Index endpoint discovery and client creation block. The LLM
+                    # streams so event stream requests get tokens as generated.
+                    _components = await asyncio.to_thread(webhook.build_components, streaming=True)
+    return _components
+
+
+async def arag_response(query: str, run: AnswerRun) -> str:
+    """Async counterpart of `webhook_cloud_function.get_rag_response`, passing answer tokens to run."""
+    llm, code_retriever, doc_retriever, jira_retriever = await get_components()
+    # The default conversation chain has memory, so each request gets its own chain
+    chain = webhook.build_chain(llm, code_retriever, doc_retriever, jira_retriever)
+    callbacks = [webhook.StageTimingHandler(), webhook.AnswerStreamHandler(run)]
+    with trace_span("chain"):
+        outputs = await chain.acall(query, callbacks=callbacks)
+    return outputs['result']
+
+
+def deadline_seconds(deadline: Optional[float]) -> float:
+    return WEBHOOK_DEADLINE_SECONDS if deadline is None else deadline
+
+
+async def answer(query: str, session: Optional[str] = None, deadline: Optional[float] = None) -> str:
+    """Returns the RAG answer, or `FALLBACK_ANSWER` if it fails or is not ready by the deadline."""
+    with trace_span("rag_answer") as attributes:
+        run, attributes["coalesced"] = inflight_queries.submit(query, arag_response, session)
+        try:
+            # Shielded: the run is shared with other requests and outlives this one
+            return await asyncio.wait_for(asyncio.shield(run.task), deadline_seconds(deadline))
+        except asyncio.TimeoutError:
+            attributes["timed_out"] = True
+            inflight_queries.defer(session, query, run)
+            return FALLBACK_ANSWER
+        except Exception as e:
+            attributes["exception"] = repr(e)
+            print(f"RAG response failed: {e!r}")
+            return FALLBACK_ANSWER
+
+
+async def stream_answer_events(run: AnswerRun):
+    """Server-sent events of run: `token` events, then a `result` (or `error`) event.
+
+    A keep-alive comment is sent every `SSE_KEEPALIVE_SECONDS` without a
+    token, e.g. while the question is routed and the retrievers run.
+    """
+    tokens = run.follow()
+    next_token = None
+    try:
+        while True:
+            if next_token is None:
+                next_token = asyncio.ensure_future(tokens.__anext__())
+            done, _ = await asyncio.wait({next_token}, timeout=SSE_KEEPALIVE_SECONDS)
+            if not done:
+                yield SSE_KEEPALIVE
+                continue
+            try:
+                token = next_token.result()
+            except StopAsyncIteration:
+                break
+            next_token = None
+            yield webhook.sse_event('token', token)
+    finally:
+        if next_token is not None and not next_token.done():
+            next_token.cancel()
+
+    try:
+        result = await run.task
+    except Exception as e:
+        print(f"Streaming RAG response failed: {e!r}")
+        yield webhook.sse_event('error', str(e))
+        return
+    yield webhook.sse_event('result', result)
+
+
+class AsgiRequest:
+    """The parts of `flask.Request` used by the webhook helpers."""
+
+    def __init__(self, scope: Dict[str, Any], body: bytes):
+        self.method = scope.get("method", "POST")
+        self.path = scope.get("path", "/")
+        self.headers = {
+            name.decode("latin-1").title(): value.decode("latin-1") for name, value in scope.get("headers", [])
+        }
+        self.body = body
+
+    def get_json(self, silent: bool = False):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            if silent:
+                return None
+            raise
+
+
+@traced_async_webhook
+async def async_hello_world(request: AsgiRequest):
+    """Async counterpart of `webhook_cloud_function.hello_world`, same requests and responses."""
+    request_json = request.get_json(silent=True) or {}
+
+    prompt = request_json.get('text', None) or ""
+    session = (request_json.get('sessionInfo') or {}).get('session')
+    tag = webhook.webhook_tag(request_json)
+    if tag is None:
+        return ('Unrecognized request', 404)
+
+    if tag == 'get-rag':
+        if webhook.wants_stream(request, request_json):
+            # Started here so the chain's spans belong to this request's trace
+            run, _ = inflight_queries.submit(prompt, arag_response, session)
+            return traced_async_stream(stream_answer_events(run))
+        return webhook.rag_fulfillment(await answer(prompt, session))
+
+    elif tag == 'dialogflow-es':
+        return webhook.dialogflow_es_fulfillment()
+
+    else:
+        return ('Not found', 404)
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def send_response(send, response) -> None:
+    """Sends a handler result: a dict as JSON, a (text, status) tuple, or an SSE event generator."""
+    if isinstance(response, tuple):
+        body, status, content_type = response[0].encode("UTF-8"), response[1], b"text/plain; charset=utf-8"
+    elif isinstance(response, dict):
+        body, status, content_type = json.dumps(response).encode("UTF-8"), 200, b"application/json"
+    else:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+        })
+        async for event in response:
+            await send({"type": "http.response.body", "body": event.encode("UTF-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def startup(loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+    (loop or asyncio.get_running_loop()).set_default_executor(
+        ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="webhook")
+    )
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    request = AsgiRequest(scope, await read_body(receive))
+    try:
+        response = await async_hello_world(request)
+    except Exception as e:
+        print(f"Webhook request failed: {e!r}")
+        response = ('Internal Server Error', 500)
+    await send_response(send, response)
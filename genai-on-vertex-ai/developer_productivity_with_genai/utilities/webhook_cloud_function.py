@@ -14,15 +14,21 @@
 # Author: Lei Pan
 
 from __future__ import annotations
+import asyncio
 import vertexai
 from vertexai.language_models import CodeGenerationModel
 
 from google.cloud import discoveryengine_v1beta
 from google.cloud.discoveryengine_v1beta.services.search_service import pagers
 from google.protobuf.json_format import MessageToDict
+import contextvars
 import json
+import queue
+import threading
 import time
+from flask import Response
 from langchain.agents import AgentType, initialize_agent, AgentExecutor, LLMSingleActionAgent, AgentOutputParser
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.manager import CallbackManagerForChainRun, Callbacks
 from langchain.chains.base import Chain
 from langchain.chains.question_answering import load_qa_chain
@@ -31,7 +37,8 @@ from langchain.llms import VertexAI
 from langchain.llms.utils import enforce_stop_tokens
 from langchain.prompts import StringPromptTemplate
 from langchain.retrievers import GoogleCloudEnterpriseSearchRetriever as EnterpriseSearchRetriever
-from langchain.schema import AgentAction, AgentFinish, Document, BaseRetriever
+from langchain.schema import AgentAction, AgentFinish, Document, BaseRetriever, LLMResult
+from langchain.schema.output import GenerationChunk
 from langchain.tools import Tool
 from langchain.utils import get_from_dict_or_env
 from pydantic import BaseModel, Extra, Field, root_validator
@@ -49,6 +56,9 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from pydantic import BaseModel
 from matching_engine import MatchingEngine
 from matching_engine_utils import MatchingEngineUtils
+from local_matching_engine import LocalMatchingEngine
+from retrieval_cache import CachedRetriever, RetrievalCache
+from webhook_tracing import OpenSpans, trace_span, traced_stream, traced_webhook
 from langchain.chains.router import MultiRetrievalQAChain
 from langchain.chains import ConversationChain
 
@@ -62,6 +72,23 @@ PROJECT_ID = "your project id for search engine project"
 DOC_SEARCH_ENGINE_ID = "doc search engine id"
 JIRA_SEARCH_ENGINE_ID = "jira search engine id"
 
+# Serve the code retriever from an in-process copy of the Matching Engine
+# export instead of the deployed index endpoint.
+ME_USE_LOCAL_INDEX = False
+ME_LOCAL_INDEX_DIR = "/tmp/me-local-index"
+ME_EMBEDDING_DIR = f"{PROJECT_ID}-me-bucket"
+
+# Loaded once per instance and reused across requests
+local_code_index = None
+
+# Per-source retrieval result caches, shared by the requests of an instance.
+# Style guides rarely change; Jira lookups repeat within minutes.
+retrieval_caches = {
+    "codebase search": RetrievalCache(ttl=10 * 60, stale_ttl=60 * 60, max_bytes=32 * 1024 * 1024),
+    "coding style guide": RetrievalCache(ttl=6 * 60 * 60, stale_ttl=24 * 60 * 60, max_bytes=16 * 1024 * 1024),
+    "jira issues search": RetrievalCache(ttl=2 * 60, stale_ttl=5 * 60, max_bytes=16 * 1024 * 1024),
+}
+
 # Utility functions for Embeddings API with rate limiting
 def rate_limit(max_per_minute):
     period = 60 / max_per_minute
@@ -101,60 +128,132 @@ class CustomVertexAIEmbeddings(VertexAIEmbeddings, BaseModel):
         return [r.values for r in results]
     
 
-def get_rag_response(query):
-    llm = VertexAI(model_name="text-unicorn@001", max_output_tokens=1024, temperature=0)
+class StreamingVertexAI(VertexAI):
+    """VertexAI whose async calls also stream answer tokens when `streaming` is set.
+
+    `VertexAI._agenerate` ignores `streaming`, so the blocking stream is read
+    in a worker thread and each chunk is reported to the async callbacks.
+    """
+
+    async def _agenerate(self, prompts, stop=None, run_manager=None, **kwargs):
+        if not self.streaming:
+            return await super()._agenerate(prompts, stop=stop, run_manager=run_manager, **kwargs)
+        generations = []
+        for prompt in prompts:
+            generation = GenerationChunk(text="")
+            chunks = self._stream(prompt, stop=stop, **kwargs)
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, STREAM_DONE)
+                if chunk is STREAM_DONE:
+                    break
+                generation += chunk
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk, verbose=self.verbose)
+            generations.append([generation])
+        return LLMResult(generations=generations)
+
+
+def get_local_matching_engine(embeddings, embedding_dir):
+    global local_code_index
+    if local_code_index is None:
+        with trace_span("local_index_load"):
+            local_code_index = LocalMatchingEngine.from_components(
+                index_dir=ME_LOCAL_INDEX_DIR,
+                embedding=embeddings,
+                gcs_bucket_name=f"gs://{embedding_dir}".split("/")[2],
+            )
+    return local_code_index
+
+
+def build_llm(streaming=False):
+    return StreamingVertexAI(model_name="text-unicorn@001", max_output_tokens=1024, temperature=0, streaming=streaming)
 
+
+def build_code_embeddings():
     EMBEDDING_QPM = 100
     EMBEDDING_NUM_BATCH = 5
-    embeddings = CustomVertexAIEmbeddings(
+    return CustomVertexAIEmbeddings(
     requests_per_minute=EMBEDDING_QPM,
     num_instances_per_batch=EMBEDDING_NUM_BATCH,
     )
 
+
+def build_code_retriever():
+    embeddings = build_code_embeddings()
+
     ME_REGION = "us-central1"
     ME_INDEX_NAME = f"{PROJECT_ID}-me-index"
-    ME_EMBEDDING_DIR = f"{PROJECT_ID}-me-bucket"
     ME_DIMENSIONS = 768  # when using Vertex PaLM Embedding
-    mengine = MatchingEngineUtils(PROJECT_ID, ME_REGION, ME_INDEX_NAME)
-    ME_INDEX_ID, ME_INDEX_ENDPOINT_ID = mengine.get_index_and_endpoint()
-    print(f"ME_INDEX_ID={ME_INDEX_ID}")
-    print(f"ME_INDEX_ENDPOINT_ID={ME_INDEX_ENDPOINT_ID}")
-
-    me = MatchingEngine.from_components(
-    project_id=PROJECT_ID,
-    region=ME_REGION,
-    gcs_bucket_name=f"gs://{ME_EMBEDDING_DIR}".split("/")[2],
-    embedding=embeddings,
-    index_id=ME_INDEX_ID,
-    endpoint_id=ME_INDEX_ENDPOINT_ID,
-    )
+    if ME_USE_LOCAL_INDEX:
+        me = get_local_matching_engine(embeddings, ME_EMBEDDING_DIR)
+    else:
+        with trace_span("me_endpoint_discovery"):
+            mengine = MatchingEngineUtils(PROJECT_ID, ME_REGION, ME_INDEX_NAME)
+            ME_INDEX_ID, ME_INDEX_ENDPOINT_ID = mengine.get_index_and_endpoint()
+        print(f"ME_INDEX_ID={ME_INDEX_ID}")
+        print(f"ME_INDEX_ENDPOINT_ID={ME_INDEX_ENDPOINT_ID}")
+
+        me = MatchingEngine.from_components(
+        project_id=PROJECT_ID,
+        region=ME_REGION,
+        gcs_bucket_name=f"gs://{ME_EMBEDDING_DIR}".split("/")[2],
+        embedding=embeddings,
+        index_id=ME_INDEX_ID,
+        endpoint_id=ME_INDEX_ENDPOINT_ID,
+        )
 
     # Create chain to answer questions
     NUMBER_OF_RESULTS = 3
     SEARCH_DISTANCE_THRESHOLD = 0.6
 
     # Expose index to the retriever
-    code_retriever = me.as_retriever(
+    return me.as_retriever(
     search_type="similarity",
     search_kwargs={
         "k": NUMBER_OF_RESULTS,
         "search_distance": SEARCH_DISTANCE_THRESHOLD,
     },
+    metadata={"retriever": "codebase search"},
     )
 
-    doc_retriever=EnterpriseSearchRetriever(
+
+def build_search_retriever(search_engine_id, name):
+    return EnterpriseSearchRetriever(
     project_id=PROJECT_ID,
-    search_engine_id=DOC_SEARCH_ENGINE_ID,
+    search_engine_id=search_engine_id,
     max_documents=3,
+    metadata={"retriever": name},
     )
 
 
-    jira_retriever=EnterpriseSearchRetriever(
-    project_id=PROJECT_ID,
-    search_engine_id=JIRA_SEARCH_ENGINE_ID,
-    max_documents=3,
-    )
+def cached_retriever(retriever, name):
+    return CachedRetriever(retriever=retriever, cache=retrieval_caches[name], source=name,
+                           metadata={"retriever": name})
+
+
+def build_components(streaming=False):
+    """Returns the LLM and the code, doc and Jira retrievers of the chain."""
+    llm = build_llm(streaming=streaming)
+    code_retriever = cached_retriever(build_code_retriever(), "codebase search")
+    doc_retriever = cached_retriever(
+        build_search_retriever(DOC_SEARCH_ENGINE_ID, "coding style guide"), "coding style guide")
+    jira_retriever = cached_retriever(
+        build_search_retriever(JIRA_SEARCH_ENGINE_ID, "jira issues search"), "jira issues search")
+    return llm, code_retriever, doc_retriever, jira_retriever
+
+
+def get_rag_response(query, callbacks=None, streaming=False):
+    with trace_span("setup"):
+        chain = build_chain(*build_components(streaming=streaming))
 
+    callbacks = list(callbacks or []) + [StageTimingHandler()]
+    with trace_span("chain"):
+        result = chain(query, callbacks=callbacks)['result']
+    print(result)
+    return result
+
+
+def build_chain(llm, code_retriever, doc_retriever, jira_retriever):
     retriever_infos = [
     {
         "name": "codebase search",
@@ -186,11 +285,209 @@ def get_rag_response(query):
     )
     default_chain=ConversationChain(llm=llm, prompt=prompt_default, input_key='query', output_key='result')
 
-    chain = MultiRetrievalQAChain.from_retrievers(llm, retriever_infos, default_chain=default_chain)
-    result = chain(query)['result']
-    print(result)
-    return result
+    return MultiRetrievalQAChain.from_retrievers(llm, retriever_infos, default_chain=default_chain)
+
+
+class ChainRunTracker(BaseCallbackHandler):
+    """Tracks the run tree of a chain call to tell routing from answer LLM runs.
+
+    The router chain calls the same LLM to pick a retriever; any LLM run
+    below an `LLMRouterChain` belongs to routing, not to the answer.
+    """
+
+    # Called on the event loop in async chain calls instead of in an executor
+    # thread, so spans keep the request's trace id and events stay ordered.
+    run_inline = True
+
+    def __init__(self):
+        self.parent_runs = {}
+        self.router_runs = set()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        self.parent_runs[run_id] = parent_run_id
+        if (serialized or {}).get("id", [""])[-1] == "LLMRouterChain":
+            self.router_runs.add(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self.parent_runs[run_id] = parent_run_id
+
+    def _in_router(self, run_id):
+        while run_id is not None:
+            if run_id in self.router_runs:
+                return True
+            run_id = self.parent_runs.get(run_id)
+        return False
+
+
+
+class AnswerStreamHandler(ChainRunTracker):
+    """Queues the tokens of the answer generation as they arrive."""
+
+    def __init__(self, tokens):
+        super().__init__()
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if not self._in_router(run_id):
+            self.tokens.put(token)
+
+
+class StageTimingHandler(ChainRunTracker):
+    """Records `routing`, `generation` and per-retriever spans of a chain call."""
+
+    def __init__(self):
+        super().__init__()
+        self.spans = OpenSpans()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        super().on_llm_start(serialized, prompts, run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+        self.spans.start(run_id, "routing" if self._in_router(run_id) else "generation")
 
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.spans.end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.spans.end(run_id, error=error)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        name = (metadata or {}).get("retriever") or (serialized or {}).get("id", ["retriever"])[-1]
+        self.spans.start(run_id, f"retriever:{name}")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self.spans.end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self.spans.end(run_id, error=error)
+
+
+STREAM_DONE = object()
+
+
+class RagResponseStream:
+    """Runs `get_rag_response` in a worker thread and yields answer tokens.
+
+    Iterating the stream yields tokens as they are generated; once it is
+    exhausted `result` holds the full answer returned by the chain.
+    """
+
+    def __init__(self, query):
+        self.result = None
+        self.error = None
+        self._tokens = queue.Queue()
+        # Copy the context so spans from the worker keep the request's trace id
+        context = contextvars.copy_context()
+        self._worker = threading.Thread(target=context.run, args=(self._run, query), daemon=True)
+        self._worker.start()
+
+    def _run(self, query):
+        try:
+            self.result = get_rag_response(
+                query, callbacks=[AnswerStreamHandler(self._tokens)], streaming=True)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._tokens.put(STREAM_DONE)
+
+    def __iter__(self):
+        while True:
+            token = self._tokens.get()
+            if token is STREAM_DONE:
+                break
+            yield token
+        if self.error is not None:
+            raise self.error
+
+    def collect(self):
+        """Drains the stream and returns the full answer."""
+        for _ in self:
+            pass
+        return self.result
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_rag_events(stream):
+    """Formats a `RagResponseStream` as server-sent events."""
+    try:
+        for token in stream:
+            yield sse_event('token', token)
+    except Exception as e:
+        print(f"Streaming RAG response failed: {e}")
+        yield sse_event('error', str(e))
+        return
+    yield sse_event('result', stream.result)
+
+
+def webhook_tag(request_json):
+    """Returns the fulfillment tag of a Dialogflow CX or ES request, or None."""
+    if request_json.get('fulfillmentInfo', None):
+        return request_json['fulfillmentInfo']['tag']
+    if request_json.get('queryResult', None):
+        return 'dialogflow-es'
+    return None
+
+
+def rag_fulfillment(result):
+    """Dialogflow CX webhook response carrying a RAG answer."""
+    response = {}
+    response['fulfillmentResponse'] = {
+        'messages': [
+            {'text': {
+                'text': ['',
+                         '']
+            }
+            },
+            {'payload': {
+                'message_payload_1': 'Sample payload message1 ',
+                'message_payload_2': 'Sample payload message2'
+            }
+            }
+        ]
+    }
+
+    # Update session variables
+    response['sessionInfo'] = {
+        'parameters': {
+            'foo': result
+        }
+    }
+
+    # Update custom payload
+    response['payload'] = {
+        'payload_1': 'Sample payload bla1',
+        'payload_2': 'Sample payload bla2'
+    }
+    return response
+
+
+def dialogflow_es_fulfillment():
+    response = {}
+    # response['fulfillmentText'] = ('This is fulfillment_text from the webhook')
+    response['fulfillmentMessages'] = [
+        {'text': {
+            'text': ['This is response 1 from the webhook',
+                     'This is response 2 from the webhook']
+        }
+        }
+    ]
+    return response
+
+
+if ME_USE_LOCAL_INDEX:
+    # Download the export and build the index when the instance starts, not
+    # within the webhook timeout of its first request
+    get_local_matching_engine(build_code_embeddings(), ME_EMBEDDING_DIR)
+
+
+def wants_stream(request, request_json):
+    """Clients opt in with `"stream": true` or `Accept: text/event-stream`."""
+    if request_json.get('stream', False):
+        return True
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+@traced_webhook
 def hello_world(request):
     """Responds to any HTTP request.
     Args:
@@ -199,6 +496,9 @@ def hello_world(request):
         The response text or any set of values that can be turned into a
         Response object using
         `make_response <http://flask.pocoo.org/docs/1.0/api/#flask.Flask.make_response>`.
+        For `get-rag` requests that set `"stream": true` or send
+        `Accept: text/event-stream`, a server-sent event stream of `token`
+        events followed by a final `result` (or `error`) event.
 
     Sample request:
     {
@@ -228,64 +528,30 @@ def hello_world(request):
     if request_json.get('text', None):
         prompt = request_json['text']
 
-    if request_json.get('fulfillmentInfo', None):
-        tag = request_json['fulfillmentInfo']['tag']
-        print('Tag: {}'.format(tag))
-    elif request_json.get('queryResult', None):
-        tag = 'dialogflow-es'
-        print('Dialogflow ES webhook request')
-    else:
+    tag = webhook_tag(request_json)
+    if tag is None:
         return ('Unrecognized request', 404)
+    print('Tag: {}'.format(tag))
 
     if tag == 'get-rag':
         # call rag and get a response:
-
-        result = get_rag_response(prompt)
+        stream = RagResponseStream(prompt)
+        if wants_stream(request, request_json):
+            # Chunked response; needs an HTTP server that does not buffer the
+            # body (e.g. 2nd gen Cloud Functions / Cloud Run).
+            return Response(traced_stream(stream_rag_events(stream)), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+        # Dialogflow CX needs the whole fulfillment in a single JSON response
+        result = stream.collect()
         # Set a response
         #result = "haha"
         print(f"debug result:{result}")
-        response = {}
-        response['fulfillmentResponse'] = {
-            'messages': [
-                {'text': {
-                    'text': ['',
-                             '']
-                }
-                },
-                {'payload': {
-                    'message_payload_1': 'Sample payload message1 ',
-                    'message_payload_2': 'Sample payload message2'
-                }
-                }
-            ]
-        }
-
-        # Update session variables
-        response['sessionInfo'] = {
-            'parameters': {
-                'foo': result
-            }
-        }
-
-        # Update custom payload
-        response['payload'] = {
-            'payload_1': 'Sample payload bla1',
-            'payload_2': 'Sample payload bla2'
-        }
-        return response
+        return rag_fulfillment(result)
 
     elif tag == 'dialogflow-es':
         # Set a response
-        response = {}
-        # response['fulfillmentText'] = ('This is fulfillment_text from the webhook')
-        response['fulfillmentMessages'] = [
-            {'text': {
-                'text': ['This is response 1 from the webhook',
-                         'This is response 2 from the webhook']
-            }
-            }
-        ]
-        return response
+        return dialogflow_es_fulfillment()
 
     else:
-        return ('Not found', 404)
\ No newline at end of file
+        return ('Not found', 404)
@@ -0,0 +1,215 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-stage latency spans for the Dialogflow webhook.
+
+Each finished span is written to stdout as one JSON line, which Cloud
+Functions ingests as a structured log entry, and is passed to any callables
+in `span_listeners` (used by the benchmark harness). When the
+`opentelemetry` API is installed and `WEBHOOK_OTEL_ENABLED=1`, the same spans
+are also recorded with the globally configured tracer provider.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+OTEL_ENABLED = otel_trace is not None and os.environ.get("WEBHOOK_OTEL_ENABLED", "") == "1"
+LOG_SPANS = True
+
+span_listeners: List[Callable[[Dict[str, Any]], None]] = []
+
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+
+
+def _tracer():
+    return otel_trace.get_tracer(__name__)
+
+
+@contextlib.contextmanager
+def start_trace(trace_id: Optional[str] = None):
+    """Tags every span recorded in this context with trace_id."""
+    token = current_trace_id.set(trace_id or uuid.uuid4().hex)
+    try:
+        yield current_trace_id.get()
+    finally:
+        current_trace_id.reset(token)
+
+
+def record_span(name: str, start: float, end: float, error: Optional[BaseException] = None, **attributes):
+    """Emits a finished span; start and end are `time.perf_counter()` values."""
+    duration_ms = (end - start) * 1000
+    span = {
+        "severity": "ERROR" if error is not None else "INFO",
+        "message": f"span {name} took {duration_ms:.1f} ms",
+        "trace_id": current_trace_id.get(),
+        "span": name,
+        "duration_ms": round(duration_ms, 3),
+        "attributes": attributes,
+    }
+    if error is not None:
+        span["error"] = repr(error)
+    if LOG_SPANS:
+        print(json.dumps(span, default=str), flush=True)
+    for listener in span_listeners:
+        listener(span)
+
+
+@contextlib.contextmanager
+def trace_span(name: str, **attributes):
+    """Times the enclosed block as one span.
+
+    Yields the attribute dict so callers can add attributes that are only
+    known once the stage has run.
+    """
+    otel_span = _tracer().start_as_current_span(name) if OTEL_ENABLED else contextlib.nullcontext()
+    start = time.perf_counter()
+    error = None
+    with otel_span as span:
+        try:
+            yield attributes
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if span is not None:
+                span.set_attributes({k: str(v) for k, v in attributes.items()})
+            record_span(name, start, time.perf_counter(), error, **attributes)
+
+
+def traced_webhook(handler):
+    """Wraps an HTTP handler in a `webhook` span of a new trace.
+
+    Dialogflow CX's `detectIntentResponseId` is used as the trace id when
+    present so log lines can be matched to a conversation turn.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(request):
+        payload = request.get_json(silent=True) or {}
+        tag = (payload.get("fulfillmentInfo") or {}).get("tag", "")
+        with start_trace(payload.get("detectIntentResponseId")), trace_span("webhook", tag=tag):
+            return handler(request)
+
+    return wrapper
+
+
+def traced_async_webhook(handler):
+    """`traced_webhook` for coroutine handlers."""
+
+    @functools.wraps(handler)
+    async def wrapper(request):
+        payload = request.get_json(silent=True) or {}
+        tag = (payload.get("fulfillmentInfo") or {}).get("tag", "")
+        with start_trace(payload.get("detectIntentResponseId")), trace_span("webhook", tag=tag):
+            return await handler(request)
+
+    return wrapper
+
+
+def _stream_span_end(spans, context, error, events, first_event_ms):
+    if isinstance(error, GeneratorExit):
+        # The client went away before the stream ended
+        error = None
+        closed = True
+    else:
+        closed = False
+    context.run(spans.end, "stream", error=error, events=events, first_event_ms=first_event_ms, closed=closed)
+
+
+def traced_stream(events):
+    """Wraps a streamed response body in a `stream` span of the current trace.
+
+    The `webhook` span ends when the handler returns the response, before
+    any event is sent; this span lasts until the body is exhausted or closed.
+    """
+    context = contextvars.copy_context()
+    spans = OpenSpans()
+    context.run(spans.start, "stream", "stream")
+    start = time.perf_counter()
+
+    def generate():
+        count, first_event_ms, error = 0, None, None
+        try:
+            for event in events:
+                if first_event_ms is None:
+                    first_event_ms = round((time.perf_counter() - start) * 1000, 3)
+                count += 1
+                yield event
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _stream_span_end(spans, context, error, count, first_event_ms)
+
+    return generate()
+
+
+def traced_async_stream(events):
+    """`traced_stream` for async generators."""
+    context = contextvars.copy_context()
+    spans = OpenSpans()
+    context.run(spans.start, "stream", "stream")
+    start = time.perf_counter()
+
+    async def generate():
+        count, first_event_ms, error = 0, None, None
+        try:
+            async for event in events:
+                if first_event_ms is None:
+                    first_event_ms = round((time.perf_counter() - start) * 1000, 3)
+                count += 1
+                yield event
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _stream_span_end(spans, context, error, count, first_event_ms)
+
+    return generate()
+
+
+class OpenSpans:
+    """Spans that start and end in different callbacks, keyed by run id."""
+
+    def __init__(self):
+        self._spans = {}
+
+    def start(self, key, name: str, **attributes):
+        otel_span = _tracer().start_span(name) if OTEL_ENABLED else None
+        self._spans[key] = (name, time.perf_counter(), attributes, otel_span)
+
+    def end(self, key, error: Optional[BaseException] = None, **attributes):
+        if key not in self._spans:
+            return
+        name, start, span_attributes, otel_span = self._spans.pop(key)
+        span_attributes.update(attributes)
+        if otel_span is not None:
+            otel_span.set_attributes({k: str(v) for k, v in span_attributes.items()})
+            if error is not None:
+                otel_span.record_exception(error)
+            otel_span.end()
+        record_span(name, start, time.perf_counter(), error, **span_attributes)
@@ -0,0 +1,153 @@
+"""
+Local stand-in for `google.cloud.bigquery.Client` used by the benchmarks.
+
+Table schemas are parsed from `bigquery_sqls/evals_bigquery.sql`. Every call
+that would be a round-trip to BigQuery is recorded as a `Job` with the size
+of its SQL and query parameter payload and the number of rows sent and
+returned, and sleeps for a simulated latency
+of `base_latency` seconds plus `bytes_per_second` transfer time. Query
+results are produced by an optional `responder(sql)` callable returning a
+pandas DataFrame.
+"""
+
+import dataclasses
+import json
+import os
+import re
+import time
+
+from google.cloud import bigquery
+
+SQL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bigquery_sqls", "evals_bigquery.sql")
+
+TYPE_MAP = {"INT": "INTEGER", "BOOL": "BOOLEAN"}
+
+
+def load_schemas(sql_path=SQL_PATH):
+    """Returns table name -> list of `bigquery.SchemaField` parsed from the DDL."""
+    with open(sql_path) as f:
+        sql = f.read()
+    schemas = {}
+    for table, body in re.findall(r"CREATE TABLE IF NOT EXISTS (\w+) \((.*?)\n\)", sql, re.S):
+        fields = []
+        for name, field_type in re.findall(r"^\s+(\w+)\s+([A-Z<>]+)\s+OPTIONS", body, re.M):
+            mode = "NULLABLE"
+            array = re.match(r"ARRAY<(\w+)>", field_type)
+            if array:
+                field_type, mode = array.group(1), "REPEATED"
+            fields.append(bigquery.SchemaField(name, TYPE_MAP.get(field_type, field_type), mode=mode))
+        schemas[table] = fields
+    return schemas
+
+
+@dataclasses.dataclass
+class Job:
+    kind: str
+    sql_bytes: int = 0
+    payload_bytes: int = 0
+    rows_sent: int = 0
+    rows_returned: int = 0
+    latency: float = 0.0
+
+
+class FakeQueryJob:
+    def __init__(self, df):
+        self._df = df
+
+    def result(self):
+        return self
+
+    def to_dataframe(self, *args, **kwargs):
+        return self._df
+
+    def to_arrow(self, *args, **kwargs):
+        import pyarrow as pa
+        return pa.Table.from_pandas(self._df, preserve_index=False)
+
+
+class FakeTable:
+    def __init__(self, table_id, schema):
+        self.table_id = table_id
+        self.schema = schema
+
+
+class FakeBigQueryClient:
+    def __init__(self, project="benchmark", base_latency=0.0, bytes_per_second=0.0, responder=None):
+        self.project = project
+        self.base_latency = base_latency
+        self.bytes_per_second = bytes_per_second
+        self.responder = responder
+        self.schemas = load_schemas()
+        self.jobs = []
+
+    def reset(self):
+        self.jobs = []
+
+    @property
+    def round_trips(self):
+        return len(self.jobs)
+
+    @property
+    def payload_bytes(self):
+        return sum(job.sql_bytes + job.payload_bytes for job in self.jobs)
+
+    @property
+    def rows_sent(self):
+        return sum(job.rows_sent for job in self.jobs)
+
+    @property
+    def rows_returned(self):
+        return sum(job.rows_returned for job in self.jobs)
+
+    def _record(self, kind, sql="", payload_bytes=0, rows_sent=0, rows_returned=0):
+        sql_bytes = len(sql.encode("UTF-8"))
+        latency = self.base_latency
+        if self.bytes_per_second:
+            latency += (sql_bytes + payload_bytes) / self.bytes_per_second
+        if latency:
+            time.sleep(latency)
+        self.jobs.append(Job(kind, sql_bytes, payload_bytes, rows_sent, rows_returned, latency))
+
+    def _respond(self, sql):
+        import pandas as pd
+        if self.responder is not None:
+            return self.responder(sql)
+        return pd.DataFrame()
+
+    def get_table(self, table_id):
+        self._record("get_table")
+        return FakeTable(table_id, self.schemas[str(table_id).split(".")[-1]])
+
+    @staticmethod
+    def _parameters_payload(job_config):
+        """Returns the serialized size of the query parameters and their array elements."""
+        payload_bytes = 0
+        rows = 0
+        for param in getattr(job_config, "query_parameters", None) or []:
+            api_repr = param.to_api_repr()
+            payload_bytes += len(json.dumps(api_repr, default=str).encode("UTF-8"))
+            rows += len(api_repr.get("parameterValue", {}).get("arrayValues", []) or [])
+        return payload_bytes, rows
+
+    def query(self, sql, job_config=None, **kwargs):
+        df = self._respond(sql)
+        payload_bytes, rows = self._parameters_payload(job_config)
+        self._record("query", sql, payload_bytes, rows_sent=rows, rows_returned=len(df))
+        return FakeQueryJob(df)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        data = file_obj.read()
+        rows = pq.ParquetFile(pa.BufferReader(data)).metadata.num_rows
+        self._record("load_table_from_file", payload_bytes=len(data), rows_sent=rows)
+        return FakeQueryJob(None)
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        self._record("delete_table")
+
+    def query_and_wait(self, sql, job_config=None, **kwargs):
+        df = self._respond(sql)
+        payload_bytes, rows = self._parameters_payload(job_config)
+        self._record("query_and_wait", sql, payload_bytes, rows_sent=rows, rows_returned=len(df))
+        return FakeQueryJob(df)
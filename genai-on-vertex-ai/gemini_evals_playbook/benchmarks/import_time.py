@@ -0,0 +1,77 @@
+"""
+Cold-start import benchmark for the `utils` package.
+
+Imports `utils.evals_playbook` in fresh interpreters, reports the median
+wall time and fails when it exceeds the budget or when any of the heavy
+dependencies (pandas, BigQuery, Vertex AI, SQLAlchemy) is imported eagerly.
+
+Run from the root of the playbook:
+    python benchmarks/import_time.py --runs 10 --budget-ms 150
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = [
+    "pandas",
+    "google.cloud.bigquery",
+    "google.cloud.aiplatform",
+    "vertexai",
+    "sqlalchemy",
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import utils.evals_playbook
+elapsed_ms = (time.perf_counter() - start) * 1000
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{"import_ms": elapsed_ms, "heavy_modules": heavy}}))
+"""
+
+
+def measure_once():
+    # Settings are resolved lazily, so importing does not read config.ini
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=ROOT_DIR, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time budget check for utils.evals_playbook")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=150.0)
+    parser.add_argument("--output", help="Write the results as JSON to this path.")
+    args = parser.parse_args()
+
+    samples = [measure_once() for _ in range(args.runs)]
+    timings = [s["import_ms"] for s in samples]
+    heavy = sorted({m for s in samples for m in s["heavy_modules"]})
+    result = {
+        "runs": args.runs,
+        "median_ms": round(statistics.median(timings), 3),
+        "max_ms": round(max(timings), 3),
+        "budget_ms": args.budget_ms,
+        "eager_heavy_modules": heavy,
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if heavy:
+        sys.exit(f"Heavy modules imported eagerly: {heavy}")
+    if result["median_ms"] > args.budget_ms:
+        sys.exit(f"Import took {result['median_ms']} ms, over the {args.budget_ms} ms budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Benchmarks for the `Evals` persistence layer against a local BigQuery stand-in.
+
+For each size, synthetic `EvalResult`s are logged and compared through
+`Evals` backed by `FakeBigQueryClient`, and every operation reports wall
+time, throughput, peak Python memory, BigQuery round-trips and bytes sent.
+Results are written as JSON so runs can be compared across versions.
+
+Run from the root of the playbook:
+    python benchmarks/persistence.py --sizes 1000 10000 100000 --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bigquery import FakeBigQueryClient  # noqa: E402
+from utils.evals_playbook import ARCHIVED_EXAMPLE_ID, Evals, metrics_table_to_arrow  # noqa: E402
+
+METRICS = ["exact_match", "rouge_1", "rouge_l_sum", "bleu"]
+TABLES = ["eval_tasks", "eval_experiments", "eval_prompts", "eval_datasets", "eval_run_details", "eval_runs"]
+
+
+class Record:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def fake_db_classes():
+    """Stand-in for the SQLAlchemy automapped classes, one plain class per table."""
+    return SimpleNamespace(classes=SimpleNamespace(**{t: type(t, (Record,), {}) for t in TABLES}))
+
+
+def synthetic_eval_result(num_examples, seed=0):
+    from vertexai.preview.evaluation import EvalResult
+
+    rng = np.random.default_rng(seed)
+    table = pd.DataFrame({
+        "prompt_id": [f"example-{i}" for i in range(num_examples)],
+        "instruction": "Summarize the article in one sentence.",
+        "context": [f"Context for example {i}. " * 8 for i in range(num_examples)],
+        "completed_prompt": [f"Summarize the article in one sentence. Article {i}: " + "lorem ipsum " * 40 for i in range(num_examples)],
+        "response": [f"Response {i}: " + "dolor sit amet " * 10 for i in range(num_examples)],
+        "reference": [f"Reference {i}: " + "consectetur adipiscing " * 8 for i in range(num_examples)],
+    })
+    for metric in METRICS:
+        table[f"{metric}/score"] = rng.random(num_examples)
+    summary = {"row_count": num_examples}
+    for metric in METRICS:
+        summary[f"{metric}/mean"] = float(table[f"{metric}/score"].mean())
+        summary[f"{metric}/std"] = float(table[f"{metric}/score"].std())
+    return EvalResult(summary_metrics=summary, metrics_table=table)
+
+
+def compare_responder(num_runs, num_examples=0, detail_runs=0, seed=0):
+    """
+    Responds to the `compare_eval_runs` query with num_runs synthetic runs and
+    to eval_run_details metric queries with num_examples examples for each of
+    the first detail_runs runs.
+    """
+    rng = np.random.default_rng(seed)
+    runs = pd.DataFrame({
+        "task_id": "task-benchmark",
+        "run_id": [f"run-{i}" for i in range(num_runs)],
+        "experiment_id": [f"experiment-{i}" for i in range(num_runs)],
+        "experiment_desc": "benchmark",
+        "model_endpoint": "aiplatform.googleapis.com",
+        "model_name": "gemini-1.5-flash-001",
+        "generation_config": [json.dumps({"temperature": float(t)}) for t in rng.random(num_runs)],
+        "prompt_template": [f"template {i % 5}" for i in range(num_runs)],
+        "system_instruction": "",
+        "metrics": [
+            json.dumps({f"{m}/{stat}": float(v) for m in METRICS for stat, v in (("mean", rng.random()), ("std", rng.random()))})
+            for _ in range(num_runs)
+        ],
+        "create_datetime": pd.Timestamp("2024-01-01"),
+    })
+    # Columns as aliased by `Evals._get_run_detail_metrics`, in METRICS order
+    details = pd.DataFrame({
+        "run_id": np.repeat(runs["run_id"].to_numpy()[:detail_runs], num_examples),
+        "example_id": np.tile([f"example-{i}" for i in range(num_examples)], detail_runs),
+    })
+    for i, _ in enumerate(METRICS):
+        details[f"metric_{i}"] = rng.random(len(details))
+
+    def respond(sql):
+        if "UNNEST(@run_ids)" not in sql:
+            return runs.copy()
+        if "LIMIT 1" in sql:
+            return pd.DataFrame({"metrics": [json.dumps({f"{m}/score": 0.5 for m in METRICS})]})
+        return details
+    return respond
+
+
+def archive_responder(details, archive_uri):
+    """Responds to the archiving queries for one old run and to reads of its summary row."""
+    run = details.iloc[0]
+    candidates = pd.DataFrame({
+        "task_id": [run["task_id"]], "experiment_id": [run["experiment_id"]], "run_id": [run["run_id"]],
+        "num_examples": [len(details)], "last_datetime": [pd.Timestamp("2024-01-01")],
+    })
+    summary = pd.DataFrame({"example_id": [ARCHIVED_EXAMPLE_ID], "metadata": [json.dumps({"archive_uri": archive_uri})]})
+
+    def respond(sql):
+        if "GROUP BY task_id, experiment_id, run_id" in sql:
+            return candidates
+        if "SELECT * FROM" in sql:
+            return details
+        if "BEGIN TRANSACTION" in sql:
+            return pd.DataFrame()
+        return summary
+    return respond
+
+
+def run_operation(client, name, size, func):
+    # Timed pass without tracemalloc, whose bookkeeping distorts timings
+    client.reset()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    round_trips, payload_bytes = client.round_trips, client.payload_bytes
+    rows_sent, rows_returned = client.rows_sent, client.rows_returned
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "operation": name,
+        "size": size,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(size / seconds, 1) if seconds else None,
+        "peak_memory_mb": round(peak / 2**20, 2),
+        "round_trips": round_trips,
+        "payload_bytes": payload_bytes,
+        "rows_sent": rows_sent,
+        "rows_returned": rows_returned,
+    }
+
+
+def benchmark_size(size, base_latency, bytes_per_second):
+    client = FakeBigQueryClient(base_latency=base_latency, bytes_per_second=bytes_per_second)
+    evals = Evals(bq_client=client, db_classes=fake_db_classes())
+    eval_result = synthetic_eval_result(size)
+    experiment = evals.Experiment(experiment_id="experiment-benchmark", task_id="task-benchmark")
+    detail_rows = [
+        dict(run_id="run-benchmark", experiment_id="experiment-benchmark", task_id="task-benchmark",
+             example_id=f"example-{i}", output_text="dolor sit amet " * 10, metrics=json.dumps({"bleu/score": 0.5}),
+             latencies=[], tags=[], create_datetime=datetime.datetime.now(), update_datetime=datetime.datetime.now())
+        for i in range(size)
+    ]
+    # Comparing runs scales with the number of runs rather than examples
+    num_runs = max(10, size // 100)
+    # Significance tests resample every example of a few dozen runs
+    detail_runs = min(num_runs, 20)
+
+    detail_table = metrics_table_to_arrow(eval_result.metrics_table, "run-benchmark", "experiment-benchmark", "task-benchmark")
+
+    results = [
+        run_operation(client, "_upsert", size, lambda: evals._upsert("run_details", detail_rows)),
+        run_operation(client, "_upsert_arrow", size, lambda: evals._upsert_arrow("run_details", detail_table)),
+        run_operation(client, "log_eval_run", size, lambda: evals.log_eval_run("run-benchmark", experiment, eval_result)),
+    ]
+    client.responder = compare_responder(num_runs, num_examples=size, detail_runs=detail_runs)
+    run_ids = [f"run-{i}" for i in range(num_runs)]
+    results += [
+        run_operation(client, "compare_eval_runs", num_runs, lambda: evals.compare_eval_runs(run_ids)),
+        run_operation(client, "grid_search", num_runs, lambda: evals.grid_search(
+            "task-benchmark", run_ids, opt_metrics=["bleu", "rouge_1"], opt_params=["prompt_template", "temperature"])),
+        run_operation(client, "compare_significance", size * detail_runs, lambda: evals.compare_eval_runs_significance(
+            run_ids[:detail_runs], metrics=[f"{m}/score" for m in METRICS], n_resamples=1000, seed=0)),
+    ]
+
+    with tempfile.TemporaryDirectory() as archive_dir:
+        details = detail_table.to_pandas()
+        archive_uri = f"{archive_dir}/task_id=task-benchmark/run_id=run-benchmark.parquet"
+        client.responder = archive_responder(details, archive_uri)
+        results += [
+            run_operation(client, "archive_run_details", size, lambda: evals.archive_eval_run_details(archive_uri=archive_dir)),
+            run_operation(client, "get_archived_detail", size, lambda: evals.get_eval_run_detail(
+                "run-benchmark", limit_offset=size, columns=["example_id", "output_text", "metrics"])),
+        ]
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Evals persistence layer")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--base-latency", type=float, default=0.0, help="Simulated seconds per BigQuery call.")
+    parser.add_argument("--bytes-per-second", type=float, default=0.0, help="Simulated upload bandwidth (0 = unlimited).")
+    parser.add_argument("--output", help="Write the results as JSON to this path.")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        results += benchmark_size(size, args.base_latency, args.bytes_per_second)
+
+    print(f"{'operation':<20}{'size':>10}{'seconds':>10}{'rows/s':>12}{'peak MB':>10}{'trips':>7}{'bytes':>14}")
+    for r in results:
+        print(f"{r['operation']:<20}{r['size']:>10}{r['seconds']:>10.3f}{r['rows_per_second'] or 0:>12.0f}"
+              f"{r['peak_memory_mb']:>10.1f}{r['round_trips']:>7}{r['payload_bytes']:>14}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
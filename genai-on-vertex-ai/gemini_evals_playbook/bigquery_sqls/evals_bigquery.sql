@@ -125,7 +125,7 @@ CREATE TABLE IF NOT EXISTS eval_run_details (
     tags                        ARRAY<STRING> OPTIONS(description="Tags associated with the run details for easy filtering and searching"),
     metadata                    STRING OPTIONS(description="Additional metadata related to the run details")
 ) 
-
+CLUSTER BY task_id, run_id
 OPTIONS(
     description="Table storing detailed information about individual evaluation runs, including ground truth and latencies",
     labels=[("tool", "vertexai-gemini-evals")]
@@ -0,0 +1,33 @@
+"""
+Archives the details of old evaluation runs to Parquet files.
+
+Run from the root of the playbook, e.g. from a scheduled job:
+    python -m utils.archive_eval_runs --older-than-days 90 --archive-uri gs://[your-bucket-name]/archive
+"""
+
+import argparse
+
+from utils.evals_playbook import Evals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive eval_run_details of old runs to Parquet")
+    parser.add_argument("--older-than-days", type=int, default=90)
+    parser.add_argument("--archive-uri", help="Local directory or gs:// URI. Defaults to the staging bucket.")
+    parser.add_argument("--task-id", default="")
+    parser.add_argument("--compression", default="zstd")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the runs that would be archived.")
+    args = parser.parse_args()
+
+    runs = Evals().archive_eval_run_details(
+        older_than_days=args.older_than_days,
+        archive_uri=args.archive_uri,
+        task_id=args.task_id,
+        dry_run=args.dry_run,
+        compression=args.compression,
+    )
+    print(runs[["task_id", "run_id", "num_examples", "last_datetime", "archive_uri"]].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
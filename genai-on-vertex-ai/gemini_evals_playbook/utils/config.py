@@ -1,35 +1,100 @@
 import os
-import sys
 import configparser
+import dataclasses
+import functools
+
+# Environment variable pointing at the config file to use. Otherwise the
+# `config.ini` at the root of the playbook (next to `utils/`) is used.
+CONFIG_PATH_ENV = "EVALS_CONFIG_PATH"
+# Any setting can be overridden with an environment variable named
+# EVALS_<SETTING>, e.g. EVALS_PROJECT_ID or EVALS_BQ_DATASET_ID.
+ENV_PREFIX = "EVALS_"
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini")
+
+# setting name -> config.ini section
+SECTIONS = {
+    "PROJECT_ID": "GCP",
+    "LOCATION": "GCP",
+    "STAGING_BUCKET": "CLOUDSTORAGE",
+    "STAGING_BUCKET_URI": "CLOUDSTORAGE",
+    "BQ_DATASET_ID": "BIGQUERY",
+    "BQ_LOCATION": "BIGQUERY",
+    "BQ_TABLES_SQL_PATH": "BIGQUERY",
+    "BQ_PREFIX": "BIGQUERY",
+    "BQ_T_EVAL_TASKS": "BIGQUERY",
+    "BQ_T_EXPERIMENTS": "BIGQUERY",
+    "BQ_T_PROMPTS": "BIGQUERY",
+    "BQ_T_DATASETS": "BIGQUERY",
+    "BQ_T_EVAL_RUN_DETAILS": "BIGQUERY",
+    "BQ_T_EVAL_RUNS": "BIGQUERY",
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    PROJECT_ID: str
+    LOCATION: str
+    STAGING_BUCKET: str
+    STAGING_BUCKET_URI: str
+    BQ_DATASET_ID: str
+    BQ_LOCATION: str
+    BQ_TABLES_SQL_PATH: str
+    BQ_PREFIX: str
+    BQ_T_EVAL_TASKS: str
+    BQ_T_EXPERIMENTS: str
+    BQ_T_PROMPTS: str
+    BQ_T_DATASETS: str
+    BQ_T_EVAL_RUN_DETAILS: str
+    BQ_T_EVAL_RUNS: str
+    config_path: str = ""
+
+
+def config_path():
+    """
+    Returns the path of the config file: `$EVALS_CONFIG_PATH` if set,
+    otherwise `config.ini` at the root of the playbook.
+    """
+    return os.environ.get(CONFIG_PATH_ENV) or DEFAULT_CONFIG_PATH
 
 
-def is_root_dir():
+def _read_config_file(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"config.ini not found at {path}. Set {CONFIG_PATH_ENV} to point to it.")
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings():
     """
-    Checks if the current working directory is the root directory of a project 
-    by looking for either the "/notebooks" or "/agents" folders.
+    Resolves the configuration once per process.
+
+    Values come from the config file, overridden by EVALS_<SETTING>
+    environment variables. Call `get_settings.cache_clear()` to re-read them.
 
     Returns:
-        bool: True if either directory exists in the current directory, False otherwise.
+        Settings: Immutable settings object.
     """
+    path = config_path()
+    config = _read_config_file(path)
+    values = {}
+    for name, section in SECTIONS.items():
+        value = os.environ.get(ENV_PREFIX + name)
+        if value is None and config.has_option(section, name):
+            value = config.get(section, name)
+        values[name] = value
+    if not values["STAGING_BUCKET_URI"] and values["STAGING_BUCKET"]:
+        values["STAGING_BUCKET_URI"] = f"gs://{values['STAGING_BUCKET']}"
+    missing = [name for name, value in values.items() if value is None]
+    if missing:
+        raise KeyError(f"Missing configuration parameters in {path}: {missing}")
+    return Settings(config_path=path, **values)
 
-    current_dir = os.getcwd()
-    # print("current dir: ", current_dir)
-    notebooks_path = os.path.join(current_dir, "notebooks")
-    agents_path = os.path.join(current_dir, "agents")
-    
-    return os.path.exists(notebooks_path) or os.path.exists(agents_path)
-
-def read_config():
-    if is_root_dir():
-        current_dir = os.getcwd()
-        config.read(current_dir + '/config.ini')
-        root_dir = current_dir
-    else:
-        root_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
-        config.read(root_dir+'/config.ini')
 
-    if not 'root_dir' in locals():  # If not found in any parent dir
-        raise FileNotFoundError("config.ini not found in current or parent directories.")
+def load_config():
+    return get_settings()
 
 
 def save_config(PROJECT_ID,
@@ -45,27 +110,16 @@ def save_config(PROJECT_ID,
     BQ_T_PROMPTS,
     BQ_T_DATASETS,
     BQ_T_EVAL_RUN_DETAILS,
-    BQ_T_EVAL_RUNS): 
-    
-    config = configparser.ConfigParser()
-
-    if is_root_dir():
-        current_dir = os.getcwd()
-        config.read(current_dir + '/config.ini')
-        root_dir = current_dir
-    else:
-        root_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
-        config.read(root_dir+'/config.ini')
-
-    if not 'root_dir' in locals():  # If not found in any parent dir
-        raise FileNotFoundError("config.ini not found in current or parent directories.")
+    BQ_T_EVAL_RUNS):
 
+    path = config_path()
+    config = _read_config_file(path)
 
     config['GCP']['PROJECT_ID'] = PROJECT_ID
     config['GCP']['LOCATION'] = LOCATION
     config['CLOUDSTORAGE']['STAGING_BUCKET'] = STAGING_BUCKET
     config['CLOUDSTORAGE']['STAGING_BUCKET_URI'] = STAGING_BUCKET_URI
-    config['BIGQUERY']['BQ_DATASET_ID'] = BQ_DATASET_ID 
+    config['BIGQUERY']['BQ_DATASET_ID'] = BQ_DATASET_ID
     config['BIGQUERY']['BQ_LOCATION'] = BQ_LOCATION
     config['BIGQUERY']['BQ_TABLES_SQL_PATH'] = BQ_TABLES_SQL_PATH
     config['BIGQUERY']['BQ_PREFIX'] = BQ_PREFIX
@@ -76,43 +130,16 @@ def save_config(PROJECT_ID,
     config['BIGQUERY']['BQ_T_EVAL_RUN_DETAILS'] = BQ_T_EVAL_RUN_DETAILS
     config['BIGQUERY']['BQ_T_EVAL_RUNS'] = BQ_T_EVAL_RUNS
 
-    with open(root_dir+'/config.ini', 'w') as configfile:  
+    with open(path, 'w') as configfile:
         config.write(configfile)
+    get_settings.cache_clear()
 
     print('All configuration paramaters saved to file!')
 
-def load_config():
-
-    config = configparser.ConfigParser()
 
-    if is_root_dir():
-        current_dir = os.getcwd()
-        config.read(current_dir + '/config.ini')
-        root_dir = current_dir
-    else:
-        root_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
-        config.read(root_dir+'/config.ini')
-
-    if not 'root_dir' in locals():  # If not found in any parent dir
-        raise FileNotFoundError("config.ini not found in current or parent directories.")
-        
-    # Make variables global for modification
-    global PROJECT_ID,LOCATION,STAGING_BUCKET,STAGING_BUCKET_URI,BQ_DATASET_ID,BQ_LOCATION,BQ_TABLES_SQL_PATH,BQ_PREFIX,BQ_T_EVAL_TASKS,BQ_T_EXPERIMENTS,BQ_T_PROMPTS,BQ_T_DATASETS,BQ_T_EVAL_RUN_DETAILS,BQ_T_EVAL_RUNS
-
-    
-    PROJECT_ID = config['GCP']['PROJECT_ID']
-    LOCATION = config['GCP']['LOCATION']
-    STAGING_BUCKET = config['CLOUDSTORAGE']['STAGING_BUCKET']
-    STAGING_BUCKET_URI = config['CLOUDSTORAGE']['STAGING_BUCKET_URI']
-    BQ_DATASET_ID = config['BIGQUERY']['BQ_DATASET_ID']
-    BQ_LOCATION = config['BIGQUERY']['BQ_LOCATION']
-    BQ_TABLES_SQL_PATH = config['BIGQUERY']['BQ_TABLES_SQL_PATH']
-    BQ_PREFIX = config['BIGQUERY']['BQ_PREFIX']
-    BQ_T_EVAL_TASKS = config['BIGQUERY']['BQ_T_EVAL_TASKS']
-    BQ_T_EXPERIMENTS = config['BIGQUERY']['BQ_T_EXPERIMENTS']
-    BQ_T_PROMPTS = config['BIGQUERY']['BQ_T_PROMPTS']
-    BQ_T_DATASETS = config['BIGQUERY']['BQ_T_DATASETS']
-    BQ_T_EVAL_RUN_DETAILS = config['BIGQUERY']['BQ_T_EVAL_RUN_DETAILS']
-    BQ_T_EVAL_RUNS = config['BIGQUERY']['BQ_T_EVAL_RUNS']
-
-config_parameters = load_config()
\ No newline at end of file
+def __getattr__(name):
+    # Keeps `from utils.config import PROJECT_ID` and `cfg.PROJECT_ID` working
+    # without reading config.ini at import time.
+    if name in SECTIONS:
+        return getattr(get_settings(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
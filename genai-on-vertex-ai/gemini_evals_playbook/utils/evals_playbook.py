@@ -4,46 +4,58 @@ import string
 import hashlib
 import uuid
 import json
+import math
+import os
 import re
 import datetime
 
-import pandas as pd
-
 from utils import config as cfg
-from google.cloud import bigquery
-from google.cloud import aiplatform
-from vertexai.preview.evaluation import EvalResult
 
-from sqlalchemy.ext.automap import automap_base
-from sqlalchemy import create_engine, MetaData, Column, String, Table
+# pandas, google-cloud-bigquery, google-cloud-aiplatform, vertexai and
+# sqlalchemy take seconds to import, so they are imported on first use
+# inside the functions that need them.
 
 
-BQ_TABLE_MAP = {
-    "tasks":        {"table_name": cfg.BQ_T_EVAL_TASKS, "keys": ["task_id"]},
-    "experiments":  {"table_name": cfg.BQ_T_EXPERIMENTS, "keys": ["task_id", "experiment_id"]},
-    "prompts":      {"table_name": cfg.BQ_T_PROMPTS, "keys": ["prompt_id"]},
-    "datasets":     {"table_name": cfg.BQ_T_DATASETS, "keys": ["dataset_id"]},
-    "runs":         {"table_name": cfg.BQ_T_EVAL_RUNS, "keys": ["task_id", "experiment_id", "run_id"]},
-    "run_details":  {"table_name": cfg.BQ_T_EVAL_RUN_DETAILS, "keys": ["task_id", "experiment_id", "run_id", "example_id"]}
-}
+def get_table_map():
+    """Table class -> BigQuery table name and merge keys from the current settings."""
+    return {
+        "tasks":        {"table_name": cfg.BQ_T_EVAL_TASKS, "keys": ["task_id"]},
+        "experiments":  {"table_name": cfg.BQ_T_EXPERIMENTS, "keys": ["task_id", "experiment_id"]},
+        "prompts":      {"table_name": cfg.BQ_T_PROMPTS, "keys": ["prompt_id"]},
+        "datasets":     {"table_name": cfg.BQ_T_DATASETS, "keys": ["dataset_id"]},
+        "runs":         {"table_name": cfg.BQ_T_EVAL_RUNS, "keys": ["task_id", "experiment_id", "run_id"]},
+        "run_details":  {"table_name": cfg.BQ_T_EVAL_RUN_DETAILS, "keys": ["task_id", "experiment_id", "run_id", "example_id"]}
+    }
+
+def __getattr__(name):
+    # `BQ_TABLE_MAP` used to be built at import time
+    if name == "BQ_TABLE_MAP":
+        return get_table_map()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_table_name_keys(table_class):
-    if table_class not in BQ_TABLE_MAP:
-        raise ValueError(f"Invalid table class '{table_class}'. Supported {list(BQ_TABLE_MAP.keys())}")
-    table = BQ_TABLE_MAP[table_class]
+    table_map = get_table_map()
+    if table_class not in table_map:
+        raise ValueError(f"Invalid table class '{table_class}'. Supported {list(table_map.keys())}")
+    table = table_map[table_class]
     return table["table_name"], table["keys"]
 
 def get_db_object(table_class):
+    from sqlalchemy import Column, String
+
     table_name, update_keys = get_table_name_keys(table_class)
     update_key_cols = [Column(key, String, primary_key=True) for key in update_keys]
     return table_name, update_key_cols
 
 def get_db_classes():
+    from sqlalchemy import create_engine, MetaData, Table
+    from sqlalchemy.ext.automap import automap_base
+
     # Define engine, metadata and session
     engine = create_engine(f'bigquery://{cfg.PROJECT_ID}')
     metadata = MetaData()
     # Auto populate metadata
-    for table_class in BQ_TABLE_MAP:
+    for table_class in get_table_map():
         table_name, update_key_cols = get_db_object(table_class)
         Table(table_name, metadata, *update_key_cols, autoload_with=engine, schema=cfg.BQ_DATASET_ID)
     # create objects
@@ -51,6 +63,273 @@ def get_db_classes():
     Base.prepare()
     return Base
 
+def get_merge_query(table_id, source, update_keys, all_keys):
+    """Builds a MERGE of `source` (a subquery or table reference) into table_id on update_keys."""
+    merge_query = f"""
+            MERGE INTO `{table_id}` AS target
+            USING (
+                {source}
+            ) AS source
+            ON {" AND ".join(f"target.{key} = source.{key}" for key in update_keys)}
+        """
+
+    if update_keys:
+        merge_query += f"""     WHEN MATCHED THEN
+                UPDATE SET {", ".join(f"target.{key} = source.{key}" for key in all_keys if key not in update_keys + ['create_datetime'])}
+        """
+
+    merge_query += f"""     WHEN NOT MATCHED THEN
+                INSERT({", ".join([key for key in all_keys])})
+                VALUES({", ".join(f"source.{key}" for key in all_keys)})
+        """
+    return merge_query
+
+# Columns of `EvalResult.metrics_table` that are not metrics
+NON_METRIC_KEYS = ['context', 'reference', 'instruction', 'prompt_id', 'completed_prompt', 'response']
+# eval_run_details column -> metrics_table column
+RUN_DETAIL_COLUMNS = {
+    "example_id": "prompt_id",
+    "input_prompt": "completed_prompt",
+    "output_text": "response",
+    "ground_truth": "reference",
+    "system_instruction": "instruction",
+}
+
+def _json_value(value):
+    # NaN/inf are not valid JSON and are stored as null
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return "null"
+    return json.dumps(value, default=str)
+
+def _json_literals(series):
+    """Encodes each value of a metrics_table column as a JSON literal, without per-row Python objects for numbers."""
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if pd.api.types.is_float_dtype(series.dtype):
+        array = pa.Array.from_pandas(series)
+        # NaN/inf are not valid JSON and are stored as null
+        text = pc.if_else(pc.is_finite(array), pc.cast(array, pa.string()), pa.scalar("null"))
+    elif pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        text = pc.cast(pa.Array.from_pandas(series), pa.string())
+    else:
+        # Object columns (explanations of model-based metrics, mixed or nested
+        # values) are encoded exactly as json.dumps of the row would, without
+        # Arrow type inference
+        text = pa.array([_json_value(v) for v in series.tolist()], type=pa.string())
+    return pc.fill_null(text, "null")
+
+def pack_json_column(metrics_table, columns):
+    """Packs the given metrics_table columns into one JSON object string per row, column by column."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if not len(metrics_table):
+        return pa.array([], type=pa.string())
+    if not columns:
+        return pa.array(["{}"] * len(metrics_table), type=pa.string())
+    parts = []
+    for i, column in enumerate(columns):
+        parts.append(("{" if i == 0 else ", ") + json.dumps(column) + ": ")
+        parts.append(_json_literals(metrics_table[column]))
+    parts.append("}")
+    return pc.binary_join_element_wise(*parts, "")
+
+def metrics_table_to_arrow(metrics_table, run_id, experiment_id, task_id, tags=[], metadata=None):
+    """
+    Converts `EvalResult.metrics_table` to `eval_run_details` rows as an Arrow table.
+
+    Works column by column: input and output columns are converted to Arrow
+    as a whole and the metric columns are packed into the `metrics` JSON
+    column with Arrow compute kernels, so memory use follows the column data
+    rather than one Python object per field.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    num_rows = len(metrics_table)
+    now = np.datetime64(datetime.datetime.now(), "us")
+
+    def text_column(name):
+        if name not in metrics_table:
+            return pa.nulls(num_rows, pa.string())
+        array = pa.Array.from_pandas(metrics_table[name])
+        return array if array.type == pa.string() else array.cast(pa.string())
+
+    def constant(value, type_):
+        return pa.array([value] * num_rows, type=type_)
+
+    metric_columns = [c for c in metrics_table.columns if c not in NON_METRIC_KEYS]
+    columns = {
+        "run_id": constant(run_id, pa.string()),
+        "experiment_id": constant(experiment_id, pa.string()),
+        "task_id": constant(task_id, pa.string()),
+    }
+    for column, source in RUN_DETAIL_COLUMNS.items():
+        columns[column] = text_column(source)
+    columns["metrics"] = pack_json_column(metrics_table, metric_columns)
+    columns["create_datetime"] = pa.array(np.full(num_rows, now))
+    columns["update_datetime"] = columns["create_datetime"]
+    columns["tags"] = constant(list(tags), pa.list_(pa.string()))
+    columns["metadata"] = constant(metadata, pa.string())
+    return pa.table(columns)
+
+def metric_value_sql(metric, column="metrics"):
+    """BigQuery expression reading one numeric metric from the JSON string in column (NULL when absent)."""
+    # Metric names such as `bleu/score` need quoting in the JSON path
+    path = "$." + json.dumps(metric)
+    return f"SAFE_CAST(JSON_VALUE({column}, '{path}') AS FLOAT64)"
+
+# Columns of the frame returned by `compare_paired_runs`
+SIGNIFICANCE_COLUMNS = ["metric", "baseline_run_id", "run_id", "num_examples", "baseline_mean", "run_mean",
+                        "mean_diff", "ci_low", "ci_high", "p_value", "significant"]
+
+def paired_bootstrap(differences, n_resamples=1000, confidence=0.95, seed=None, max_chunk_elements=2**22):
+    """
+    Paired bootstrap of the mean of each column of `differences` (examples x comparisons).
+
+    All columns share the same resamples. Resamples are drawn in chunks as one
+    index matrix, turned into per-example counts with a single `bincount`, and
+    the resampled means of every column are one matrix product per chunk.
+
+    Returns:
+        dict of arrays with one value per column: mean, ci_low, ci_high and
+        the two-sided p_value for a mean difference of zero.
+    """
+    import numpy as np
+
+    differences = np.asarray(differences, dtype=np.float64)
+    if differences.ndim == 1:
+        differences = differences[:, None]
+    num_examples = differences.shape[0]
+    if not num_examples:
+        raise ValueError("No paired examples to resample")
+
+    rng = np.random.default_rng(seed)
+    observed = differences.mean(axis=0)
+    means = np.empty((n_resamples, differences.shape[1]))
+    chunk = max(1, min(n_resamples, max_chunk_elements // num_examples))
+    for start in range(0, n_resamples, chunk):
+        size = min(chunk, n_resamples - start)
+        indexes = rng.integers(0, num_examples, size=(size, num_examples))
+        indexes += np.arange(size)[:, None] * num_examples
+        counts = np.bincount(indexes.ravel(), minlength=size * num_examples).reshape(size, num_examples)
+        means[start:start + size] = counts.astype(np.float64) @ differences / num_examples
+
+    alpha = 1 - confidence
+    ci_low, ci_high = np.quantile(means, [alpha / 2, 1 - alpha / 2], axis=0)
+    # Centering the bootstrap distribution on zero gives the null distribution
+    extreme = (np.abs(means - observed) >= np.abs(observed)).sum(axis=0)
+    return {
+        "mean": observed,
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+        "p_value": (extreme + 1) / (n_resamples + 1),
+    }
+
+def compare_paired_runs(details, baseline_run_id, run_ids, metrics=None, n_resamples=1000, confidence=0.95, seed=None):
+    """
+    Compares each run in run_ids against baseline_run_id on per-example metrics.
+
+    Args:
+        details: Frame with run_id, example_id and one numeric column per metric.
+        baseline_run_id: Run the others are compared against.
+        run_ids: Runs to compare. The baseline is skipped if included.
+        metrics: Metric columns to compare. Defaults to all of them.
+
+    Returns:
+        A frame with one row per (metric, run): means, the mean difference
+        (run - baseline) with its bootstrap confidence interval and p-value.
+        Only examples scored in the baseline and in every compared run are used.
+    """
+    import pandas as pd
+
+    if metrics is None:
+        metrics = [c for c in details.columns if c not in ("run_id", "example_id")]
+    candidates = [run for run in run_ids if run != baseline_run_id]
+    rows = []
+    for metric in metrics:
+        scores = details.pivot_table(index="example_id", columns="run_id", values=metric, aggfunc="mean")
+        present = [run for run in candidates if run in scores.columns]
+        if baseline_run_id not in scores.columns or not present:
+            continue
+        scores = scores[[baseline_run_id] + present].dropna()
+        if scores.empty:
+            continue
+        values = scores.to_numpy(dtype="float64")
+        stats = paired_bootstrap(values[:, 1:] - values[:, :1], n_resamples, confidence, seed)
+        run_means = values.mean(axis=0)
+        for i, run_id in enumerate(present):
+            rows.append({
+                "metric": metric,
+                "baseline_run_id": baseline_run_id,
+                "run_id": run_id,
+                "num_examples": len(values),
+                "baseline_mean": run_means[0],
+                "run_mean": run_means[i + 1],
+                "mean_diff": stats["mean"][i],
+                "ci_low": stats["ci_low"][i],
+                "ci_high": stats["ci_high"][i],
+                "p_value": stats["p_value"][i],
+                "significant": bool(stats["p_value"][i] < 1 - confidence),
+            })
+    return pd.DataFrame(rows, columns=SIGNIFICANCE_COLUMNS)
+
+# example_id of the summary row left in eval_run_details for an archived run
+ARCHIVED_EXAMPLE_ID = "__archived__"
+
+def default_archive_uri():
+    return f"{cfg.STAGING_BUCKET_URI}/eval_run_details_archive"
+
+def archive_path(archive_uri, task_id, run_id):
+    """Location of the Parquet file holding the archived details of one run."""
+    return f"{archive_uri.rstrip('/')}/task_id={task_id}/run_id={run_id}.parquet"
+
+def _archive_filesystem(uri):
+    """Returns a pyarrow filesystem and path for a local path or a gs:// URI."""
+    import pyarrow.fs as pafs
+
+    if "://" in uri:
+        return pafs.FileSystem.from_uri(uri)
+    return pafs.LocalFileSystem(), os.path.abspath(uri)
+
+def write_archive(table, uri, compression="zstd"):
+    """Writes an Arrow table to uri as Parquet and returns the number of rows read back from its footer."""
+    import pyarrow.parquet as pq
+
+    fs, path = _archive_filesystem(uri)
+    fs.create_dir(path.rsplit("/", 1)[0], recursive=True)
+    pq.write_table(table, path, filesystem=fs, compression=compression)
+    with fs.open_input_file(path) as f:
+        return pq.ParquetFile(f).metadata.num_rows
+
+def read_archive(uri, columns=None, limit=None):
+    """
+    Reads archived run details from a Parquet file.
+
+    Only the requested columns are read, and with limit only the first
+    record batches needed to fill it.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    fs, path = _archive_filesystem(uri)
+    with fs.open_input_file(path) as f:
+        parquet = pq.ParquetFile(f)
+        if limit is None:
+            return parquet.read(columns=columns)
+        batches, num_rows = [], 0
+        for batch in parquet.iter_batches(batch_size=min(max(limit, 1), 65536), columns=columns):
+            batches.append(batch)
+            num_rows += batch.num_rows
+            if num_rows >= limit:
+                break
+        schema = parquet.schema_arrow
+        if columns is not None:
+            schema = pa.schema([schema.field(column) for column in columns])
+        return pa.Table.from_batches(batches, schema=schema).slice(0, limit)
+
 def format_dt(dt: datetime.datetime):
     return dt.strftime("%m-%d-%Y_%H:%M:%S")
 
@@ -62,14 +341,26 @@ def generate_uuid(text: str):
 
 
 class Evals():
-    def __init__(self):
-        Base = get_db_classes()
+    def __init__(self, bq_client=None, db_classes=None):
+        """
+        Args:
+            bq_client: `bigquery.Client` to use. Created on first use when not passed.
+            db_classes: Automapped table classes. Reflected from BigQuery when not passed.
+        """
+        Base = db_classes if db_classes is not None else get_db_classes()
         self.Task = Base.classes.eval_tasks
         self.Experiment = Base.classes.eval_experiments
         self.Prompt = Base.classes.eval_prompts
         self.EvalDataset = Base.classes.eval_datasets
         self.EvalRunDetail = Base.classes.eval_run_details
         self.EvalRun = Base.classes.eval_runs
+        self.bq_client = bq_client
+
+    def _client(self):
+        if self.bq_client is None:
+            from google.cloud import bigquery
+            self.bq_client = bigquery.Client(project=cfg.PROJECT_ID)
+        return self.bq_client
 
     def log_task(self, task):
         try:
@@ -96,8 +387,8 @@ class Evals():
             raise e
         
     def _get_all(self, table_class, limit_offset=20, as_dict=False):
-        client = bigquery.Client(project=cfg.PROJECT_ID)
-        table_name = BQ_TABLE_MAP.get(table_class).get("table_name")
+        client = self._client()
+        table_name = get_table_map().get(table_class).get("table_name")
         table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{table_name}"
         table = client.get_table(table_id)
         cols = [schema.name for schema in table.schema]
@@ -130,12 +421,15 @@ class Evals():
         return self._get_all("run_details", limit_offset, as_dict)
 
 
-    def _get_one(self, table_class, where_keys, limit_offset=1, as_dict=False):
-        client = bigquery.Client(project=cfg.PROJECT_ID)
-        table_name = BQ_TABLE_MAP.get(table_class).get("table_name")
+    def _get_one(self, table_class, where_keys, limit_offset=1, as_dict=False, columns=None):
+        client = self._client()
+        table_name = get_table_map().get(table_class).get("table_name")
         table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{table_name}"
-        table = client.get_table(table_id)
-        cols = [schema.name for schema in table.schema]
+        if columns:
+            cols = list(columns)
+        else:
+            table = client.get_table(table_id)
+            cols = [schema.name for schema in table.schema]
         
         if where_keys:
             where_clause = "WHERE "
@@ -172,6 +466,8 @@ class Evals():
             raise Exception(f"Prompt ID is required.")
 
     def get_eval_runs(self, experiment_id, experiment_run_id: str="", task_id: str="", as_dict=False):
+        import pandas as pd
+
         where_keys = {}
         if not experiment_run_id:
             print("[INFO] experiment_run_id not passed. Showing last 5 runs (if available).")
@@ -203,17 +499,30 @@ class Evals():
         else:
             raise Exception(f"experiment_id is required.")
 
-    def compare_eval_runs(self, experiment_run_ids, as_dict=False):
+    def compare_eval_runs(self, experiment_run_ids, as_dict=False, significance=False, baseline_run_id=None,
+                          n_resamples=1000, confidence=0.95):
+        """
+        Compares the summary metrics and configuration of runs.
+
+        With `significance=True`, also returns the paired bootstrap comparison of
+        per-example metrics against baseline_run_id (default: the first run) from
+        `compare_eval_runs_significance`, as a `(comparison, significance)` tuple.
+        """
+        import pandas as pd
+
         if not experiment_run_ids:
             raise Exception(f"experiment_run_ids are required to compare runs")
 
         if isinstance(experiment_run_ids, str):
             experiment_run_ids = [experiment_run_ids]
+        if significance:
+            significance_df = self.compare_eval_runs_significance(
+                experiment_run_ids, baseline_run_id=baseline_run_id, n_resamples=n_resamples, confidence=confidence)
         if isinstance(experiment_run_ids, list):
             experiment_run_ids = ", ".join([f"'{run}'" for run in experiment_run_ids])
 
         table_prefix = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}"
-        client = bigquery.Client(project=cfg.PROJECT_ID)
+        client = self._client()
 
         sql = f"""
         SELECT
@@ -229,13 +538,13 @@ class Evals():
             runs.metrics,
             runs.create_datetime
         FROM 
-            `{table_prefix}.{BQ_TABLE_MAP.get('runs').get('table_name')}` runs
+            `{table_prefix}.{get_table_map().get('runs').get('table_name')}` runs
         JOIN 
-            `{table_prefix}.{BQ_TABLE_MAP.get('experiments').get('table_name')}` exp
+            `{table_prefix}.{get_table_map().get('experiments').get('table_name')}` exp
         ON 
             runs.experiment_id = exp.experiment_id
         LEFT JOIN 
-            `{table_prefix}.{BQ_TABLE_MAP.get('prompts').get('table_name')}` prompt
+            `{table_prefix}.{get_table_map().get('prompts').get('table_name')}` prompt
         ON 
             exp.prompt_id = prompt.prompt_id
         WHERE runs.run_id IN ({experiment_run_ids})
@@ -260,12 +569,97 @@ class Evals():
         # print(f'df:  {df.columns}')
 
 
+        if significance:
+            if as_dict:
+                return df.T.to_dict(orient='records'), significance_df.to_dict(orient='records')
+            return df.T, significance_df
+
         if as_dict:
             return df.T.to_dict(orient='records')
         else:
             return df.T
 
-    def grid_search(self, task_id, experiment_run_ids, opt_metrics, opt_params):
+    def _get_run_detail_metrics(self, experiment_run_ids, metrics=None):
+        """
+        Returns per-example metric values of runs from eval_run_details.
+
+        The values are extracted from the `metrics` JSON in BigQuery, so only
+        run_id, example_id and one float column per metric are transferred.
+        When metrics is not passed, the numeric metrics of one stored row are used.
+        """
+        import pandas as pd
+        from google.cloud import bigquery
+
+        client = self._client()
+        table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{get_table_map().get('run_details').get('table_name')}"
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("run_ids", "STRING", list(experiment_run_ids))]
+        )
+
+        if not metrics:
+            sql = f"""
+            SELECT metrics
+            FROM `{table_id}`
+            WHERE run_id IN UNNEST(@run_ids) AND metrics IS NOT NULL
+            LIMIT 1
+            """
+            sample = client.query_and_wait(sql, job_config=job_config).to_dataframe()
+            if sample.empty:
+                return pd.DataFrame(columns=["run_id", "example_id"])
+            metrics = [
+                name for name, value in json.loads(sample["metrics"].iloc[0]).items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)
+            ]
+
+        # Metric names such as `bleu/score` are not valid column names
+        extracts = ",\n                ".join(
+            f"{metric_value_sql(metric)} AS metric_{i}" for i, metric in enumerate(metrics)
+        )
+        sql = f"""
+            SELECT
+                run_id,
+                example_id,
+                {extracts}
+            FROM `{table_id}`
+            WHERE run_id IN UNNEST(@run_ids)
+        """
+        df = client.query_and_wait(sql, job_config=job_config).to_dataframe()
+        return df.rename(columns={f"metric_{i}": metric for i, metric in enumerate(metrics)})
+
+    def compare_eval_runs_significance(self, experiment_run_ids, baseline_run_id=None, metrics=None,
+                                       n_resamples=1000, confidence=0.95, seed=None):
+        """
+        Tests whether runs differ from a baseline run on per-example metrics.
+
+        Examples are paired on example_id and the mean difference of each metric
+        is resampled with a paired bootstrap (see `paired_bootstrap`).
+
+        Args:
+            experiment_run_ids: List of run IDs to compare.
+            baseline_run_id: Run to compare against. Defaults to the first run.
+            metrics: Per-example metrics to compare (e.g. ["bleu/score"]). Defaults to all numeric metrics.
+            n_resamples: Number of bootstrap resamples.
+            confidence: Confidence level of the intervals; differences with
+                p_value < 1 - confidence are flagged as significant.
+            seed: Seed for reproducible resamples.
+
+        Returns:
+            A DataFrame with one row per metric and compared run.
+        """
+        if not experiment_run_ids:
+            raise Exception(f"experiment_run_ids are required to compare runs")
+        if isinstance(experiment_run_ids, str):
+            experiment_run_ids = [experiment_run_ids]
+
+        run_ids = list(experiment_run_ids)
+        baseline_run_id = baseline_run_id or run_ids[0]
+        if baseline_run_id not in run_ids:
+            run_ids.insert(0, baseline_run_id)
+        details = self._get_run_detail_metrics(run_ids, metrics)
+        return compare_paired_runs(details, baseline_run_id, run_ids, metrics, n_resamples, confidence, seed)
+
+    def grid_search(self, task_id, experiment_run_ids, opt_metrics, opt_params, significance=False,
+                    n_resamples=1000, confidence=0.95):
         """
         Performs grid search on the evaluation results and returns the best parameter combinations for each metric.
 
@@ -274,9 +668,15 @@ class Evals():
             experiment_run_ids: List of experiment run IDs to include in the grid search.
             opt_metrics: List of metrics to optimize (e.g., ["ROUGE_1", "BLEU"]).
             opt_params: List of parameters to consider in the grid search (e.g., ["prompt_template", "temperature"]).
+            significance: Also compare the best run against every other run on the
+                per-example `<metric>/score` values with a paired bootstrap.
+            n_resamples: Number of bootstrap resamples when significance is set.
+            confidence: Confidence level of the intervals when significance is set.
 
         Returns:
             A dictionary where keys are the optimization metrics and values are the corresponding best parameter combinations.
+            With significance, each value also has a "significance" list of the
+            other runs' differences from the best run.
         """
 
         # Get 
@@ -288,6 +688,11 @@ class Evals():
         # Initialize a dictionary to store the best parameter combinations for each metric
         best_params = {}
 
+        if significance:
+            run_ids = list(filtered_df['run_id'])
+            score_cols = [metric.lower() + "/score" for metric in opt_metrics]
+            details = self._get_run_detail_metrics(run_ids, score_cols)
+
         for metric in opt_metrics:
             # Convert metric name to the corresponding column name in grid_df
             metric_mean_col = metric.lower().replace("_", "_") + "/mean" 
@@ -302,10 +707,21 @@ class Evals():
                 "metric_mean": best_row[metric_mean_col],
                 "metric_std": best_row[metric_std_col]
             }
+            if significance:
+                best_params[metric]["significance"] = compare_paired_runs(
+                    details, best_row['run_id'], run_ids, [metric.lower() + "/score"], n_resamples, confidence
+                ).to_dict(orient='records')
 
         return best_params  
 
-    def get_eval_run_detail(self, experiment_run_id, task_id: str="", limit_offset=100, as_dict=False):
+    def get_eval_run_detail(self, experiment_run_id, task_id: str="", limit_offset=100, as_dict=False, columns=None):
+        """
+        Returns the per-example details of a run.
+
+        Runs archived with `archive_eval_run_details` are read from their
+        Parquet file. Pass columns (e.g. ["example_id", "output_text"]) to
+        read only those columns, from BigQuery or from the archive.
+        """
         where_keys = {}
         if not experiment_run_id:
             raise Exception(f"experiment_run_id is required is to get run detail.")
@@ -314,7 +730,15 @@ class Evals():
 
         if task_id:
             where_keys["task_id"] = task_id
-        details_df = self._get_one("run_details", where_keys, limit_offset=limit_offset, as_dict=False)
+        # example_id and metadata tell an archived run's summary row apart
+        query_columns = None if columns is None else list(dict.fromkeys(list(columns) + ["example_id", "metadata"]))
+        details_df = self._get_one("run_details", where_keys, limit_offset=limit_offset, as_dict=False,
+                                   columns=query_columns)
+        if len(details_df) == 1 and details_df["example_id"].iloc[0] == ARCHIVED_EXAMPLE_ID:
+            archive = json.loads(details_df["metadata"].iloc[0])
+            details_df = read_archive(archive["archive_uri"], columns=columns, limit=limit_offset).to_pandas()
+        elif columns is not None:
+            details_df = details_df[list(columns)]
         if as_dict:
             return details_df.T.to_dict(orient='records')
         else:
@@ -322,6 +746,181 @@ class Evals():
             return details_df
 
 
+    def diff_eval_runs(self, baseline_run_id, candidate_run_id, metric, top_n=10, task_id: str="", as_dict=False):
+        """
+        Finds the examples whose metric changed most between two runs.
+
+        Both runs are joined on example_id and the per-example deltas are
+        computed and ranked in BigQuery, so only the top_n regressions and
+        top_n improvements are downloaded.
+
+        Args:
+            baseline_run_id: Run to compare against.
+            candidate_run_id: Run being evaluated.
+            metric: Per-example metric (e.g. "bleu/score"). "/score" is appended
+                when no suffix is given, e.g. "bleu".
+            top_n: Number of regressions and of improvements to return.
+            task_id: Optional task ID to filter both runs.
+
+        Returns:
+            A DataFrame with one row per example: change ("regression" or
+            "improvement"), example_id, input_prompt, ground_truth, the baseline
+            and candidate outputs and scores, and delta (candidate - baseline).
+            Regressions come first, largest change first.
+        """
+        from google.cloud import bigquery
+
+        if not baseline_run_id or not candidate_run_id:
+            raise Exception(f"baseline_run_id and candidate_run_id are required to diff runs")
+        if "/" not in metric:
+            metric = metric.lower() + "/score"
+
+        client = self._client()
+        table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{get_table_map().get('run_details').get('table_name')}"
+        task_filter = "AND task_id = @task_id" if task_id else ""
+        sql = f"""
+        WITH baseline AS (
+            SELECT example_id, input_prompt, ground_truth, output_text, {metric_value_sql(metric)} AS score
+            FROM `{table_id}`
+            WHERE run_id = @baseline_run_id {task_filter}
+        ),
+        candidate AS (
+            SELECT example_id, output_text, {metric_value_sql(metric)} AS score
+            FROM `{table_id}`
+            WHERE run_id = @candidate_run_id {task_filter}
+        ),
+        deltas AS (
+            SELECT
+                baseline.example_id,
+                baseline.input_prompt,
+                baseline.ground_truth,
+                baseline.output_text AS baseline_output,
+                candidate.output_text AS candidate_output,
+                baseline.score AS baseline_score,
+                candidate.score AS candidate_score,
+                candidate.score - baseline.score AS delta
+            FROM baseline
+            JOIN candidate USING (example_id)
+            WHERE baseline.score IS NOT NULL AND candidate.score IS NOT NULL
+        )
+        SELECT * FROM (
+            SELECT 'regression' AS change, * FROM deltas WHERE delta < 0 ORDER BY delta LIMIT @top_n
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT 'improvement' AS change, * FROM deltas WHERE delta > 0 ORDER BY delta DESC LIMIT @top_n
+        )
+        ORDER BY change DESC, ABS(delta) DESC
+        """
+        query_parameters = [
+            bigquery.ScalarQueryParameter("baseline_run_id", "STRING", baseline_run_id),
+            bigquery.ScalarQueryParameter("candidate_run_id", "STRING", candidate_run_id),
+            bigquery.ScalarQueryParameter("top_n", "INT64", top_n),
+        ]
+        if task_id:
+            query_parameters.append(bigquery.ScalarQueryParameter("task_id", "STRING", task_id))
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+
+        df = client.query_and_wait(sql, job_config=job_config).to_dataframe()
+        df.insert(1, "metric", metric)
+        if as_dict:
+            return df.to_dict(orient='records')
+        else:
+            return df
+
+    def archive_eval_run_details(self, older_than_days=90, archive_uri=None, task_id: str="", dry_run=False,
+                                 compression="zstd"):
+        """
+        Moves the details of old runs out of eval_run_details into Parquet files.
+
+        Each run whose newest detail row is older than older_than_days is
+        written to `<archive_uri>/task_id=<task>/run_id=<run>.parquet`, checked
+        against the file footer, and its rows in eval_run_details are replaced
+        in one transaction by a single summary row (example_id
+        `ARCHIVED_EXAMPLE_ID`) whose metadata points to the file.
+        `get_eval_run_detail` reads archived runs from there; queries that run
+        in BigQuery, such as `diff_eval_runs` and the significance tests, only
+        see runs that are not archived.
+
+        Args:
+            older_than_days: Retention window in days.
+            archive_uri: Local directory or gs:// URI. Defaults to
+                `<STAGING_BUCKET_URI>/eval_run_details_archive`.
+            task_id: Optional task ID to limit archiving to.
+            dry_run: Only return the runs that would be archived.
+            compression: Parquet compression codec.
+
+        Returns:
+            A DataFrame with one row per archived (or, with dry_run, eligible) run.
+        """
+        from google.cloud import bigquery
+
+        archive_uri = archive_uri or default_archive_uri()
+        client = self._client()
+        table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{get_table_map().get('run_details').get('table_name')}"
+        task_filter = "AND task_id = @task_id" if task_id else ""
+        query_parameters = [
+            bigquery.ScalarQueryParameter("archived_example_id", "STRING", ARCHIVED_EXAMPLE_ID),
+            bigquery.ScalarQueryParameter("older_than_days", "INT64", older_than_days),
+        ]
+        if task_id:
+            query_parameters.append(bigquery.ScalarQueryParameter("task_id", "STRING", task_id))
+        sql = f"""
+            SELECT task_id, experiment_id, run_id, COUNT(*) AS num_examples, MAX(create_datetime) AS last_datetime
+            FROM `{table_id}`
+            WHERE example_id != @archived_example_id {task_filter}
+            GROUP BY task_id, experiment_id, run_id
+            HAVING MAX(create_datetime) < DATETIME_SUB(CURRENT_DATETIME(), INTERVAL @older_than_days DAY)
+            ORDER BY last_datetime
+        """
+        runs = client.query_and_wait(sql, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters)).to_dataframe()
+        runs["archive_uri"] = [archive_path(archive_uri, row.task_id, row.run_id) for row in runs.itertuples()]
+        if dry_run:
+            return runs
+
+        for run in runs.itertuples():
+            run_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("task_id", "STRING", run.task_id),
+                bigquery.ScalarQueryParameter("experiment_id", "STRING", run.experiment_id),
+                bigquery.ScalarQueryParameter("run_id", "STRING", run.run_id),
+                bigquery.ScalarQueryParameter("archived_example_id", "STRING", ARCHIVED_EXAMPLE_ID),
+            ])
+            run_filter = "task_id = @task_id AND experiment_id = @experiment_id AND run_id = @run_id"
+            sql = f"""
+                SELECT * FROM `{table_id}`
+                WHERE {run_filter} AND example_id != @archived_example_id
+                ORDER BY example_id
+            """
+            table = client.query_and_wait(sql, job_config=run_config).to_arrow()
+            written = write_archive(table, run.archive_uri, compression=compression)
+            if written != run.num_examples:
+                raise Exception(f"Archive of run {run.run_id} has {written} rows, expected {run.num_examples}. "
+                                f"Run not archived.")
+
+            metadata = json.dumps({
+                "archive_uri": run.archive_uri,
+                "num_examples": written,
+                "columns": table.column_names,
+                "archived_datetime": datetime.datetime.now().isoformat(),
+            })
+            run_config.query_parameters = run_config.query_parameters + [
+                bigquery.ScalarQueryParameter("metadata", "STRING", metadata)
+            ]
+            # The summary row keeps the run's creation time so retention windows still apply
+            sql = f"""
+                DECLARE created DATETIME DEFAULT (
+                    SELECT MAX(create_datetime) FROM `{table_id}` WHERE {run_filter}
+                );
+                BEGIN TRANSACTION;
+                DELETE FROM `{table_id}` WHERE {run_filter};
+                INSERT INTO `{table_id}` (run_id, experiment_id, task_id, example_id, metadata, create_datetime, update_datetime)
+                VALUES (@run_id, @experiment_id, @task_id, @archived_example_id, @metadata, created, CURRENT_DATETIME());
+                COMMIT TRANSACTION;
+            """
+            client.query_and_wait(sql, job_config=run_config)
+            print(f"[INFO] Archived {written} rows of run {run.run_id} to {run.archive_uri}")
+        return runs
+
     def _upsert(self, table_class, rows, debug=False):
         """Inserts or updates rows in the specified BigQuery table.
 
@@ -331,6 +930,8 @@ class Evals():
             update_keys: A list of keys to use for updating existing rows.
         """
 
+        from google.cloud import bigquery
+
         table_name, update_keys = get_table_name_keys(table_class)
 
         if isinstance(rows, dict):
@@ -345,28 +946,12 @@ class Evals():
 
         # Get BigQuery table schema
         table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{table_name}"
-        client = bigquery.Client(project=cfg.PROJECT_ID)
+        client = self._client()
         table = client.get_table(table_id)
         schema = {schema.name:schema.field_type for schema in table.schema}
 
         # Construct the MERGE query dynamically
-        merge_query = f"""
-            MERGE INTO `{table_id}` AS target
-            USING (
-                SELECT * FROM UNNEST(@rows)
-            ) AS source
-            ON {" AND ".join(f"target.{key} = source.{key}" for key in update_keys)}
-        """
-
-        if update_keys:
-            merge_query += f"""     WHEN MATCHED THEN
-                UPDATE SET {", ".join(f"target.{key} = source.{key}" for key in all_keys if key not in update_keys + ['create_datetime'])}
-        """
-
-        merge_query += f"""     WHEN NOT MATCHED THEN
-                INSERT({", ".join([key for key in all_keys])})
-                VALUES({", ".join(f"source.{key}" for key in all_keys)})
-        """
+        merge_query = get_merge_query(table_id, "SELECT * FROM UNNEST(@rows)", update_keys, all_keys)
 
         # Convert rows to BigQuery format 
         rows_for_query = []
@@ -398,6 +983,51 @@ class Evals():
 
         query_job = client.query(merge_query, job_config=job_config)
         query_job.result()  # Wait for the MERGE to complete
+
+    def _upsert_arrow(self, table_class, table):
+        """Inserts or updates the rows of an Arrow table in the specified BigQuery table.
+
+        The table is written as Parquet into a staging table with a single
+        load job and merged with one MERGE statement, instead of sending every
+        field as a query parameter.
+
+        Args:
+            table_class: Table class, e.g. `run_details`.
+            table: `pyarrow.Table` whose column names match the BigQuery table.
+        """
+        import io
+        import pyarrow.parquet as pq
+        from google.cloud import bigquery
+
+        table_name, update_keys = get_table_name_keys(table_class)
+        for key in update_keys:
+            if key not in table.column_names:
+                raise ValueError(f"Update key '{key}' not found in columns: {table.column_names}")
+
+        client = self._client()
+        table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}.{table_name}"
+        schema = {field.name: field for field in client.get_table(table_id).schema}
+        staging_table_id = f"{cfg.PROJECT_ID}.{cfg.BQ_DATASET_ID}._staging_{table_name}_{uuid.uuid4().hex}"
+
+        parquet_file = io.BytesIO()
+        pq.write_table(table, parquet_file, compression="snappy")
+        parquet_file.seek(0)
+
+        parquet_options = bigquery.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            schema=[schema[name] for name in table.column_names],
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        job_config.parquet_options = parquet_options
+
+        merge_query = get_merge_query(table_id, f"SELECT * FROM `{staging_table_id}`", update_keys, table.column_names)
+        try:
+            client.load_table_from_file(parquet_file, staging_table_id, job_config=job_config).result()
+            client.query(merge_query).result()
+        finally:
+            client.delete_table(staging_table_id, not_found_ok=True)
     
     def log_experiment(self,
                        task_id,
@@ -408,6 +1038,8 @@ class Evals():
                        is_streaming=False,
                        tags=[],
                        metadata={}):
+        from google.cloud import aiplatform
+
         # create experiment object
         experiment = self.Experiment(
             experiment_id=experiment_id,
@@ -474,6 +1106,8 @@ class Evals():
                      tags=[],
                      metadata={}
     ):
+        from vertexai.preview.evaluation import EvalResult
+
         # log run details
         if not isinstance(eval_result, EvalResult):
             raise Exception(f"Invalid eval_result object. Expected: `vertexai.preview.evaluation.EvalResult` Actual: {type(eval_result)}")
@@ -483,35 +1117,20 @@ class Evals():
             raise Exception(f"Invalid experiment object. Expected: `Experiment` Actual: {type(experiment)}")
         
         # get run details from the Rapid Eval evaluation task
-        detail_df = eval_result.metrics_table.to_dict(orient="records")
         summary_dict = eval_result.summary_metrics
-        non_metric_keys = ['context', 'reference', 'instruction', 'prompt_id', 'completed_prompt', 'response']
-
-        # prepare run details        
-        run_details = []
-        for row in detail_df:
-            metrics = {k: row[k] for k in row if k not in non_metric_keys}
-            run_detail = dict(
-                run_id=experiment_run_id,
-                experiment_id=experiment.experiment_id,
-                task_id=experiment.task_id,
-                example_id=row.get("prompt_id"),
-                input_prompt=row.get("completed_prompt"),
-                output_text=row.get("response"),
-                ground_truth=row.get("reference"),
-                system_instruction=row.get("instruction"),
-                metrics=json.dumps(metrics),
-                # additional fields
-                latencies=[],
-                create_datetime=datetime.datetime.now(),
-                update_datetime=datetime.datetime.now(),
-                tags=tags,
-                metadata=json.dumps(metadata) if isinstance(metadata, dict) else None
-                )
-            run_details.append(run_detail)
-        
+
+        # prepare run details as columns
+        run_details = metrics_table_to_arrow(
+            eval_result.metrics_table,
+            run_id=experiment_run_id,
+            experiment_id=experiment.experiment_id,
+            task_id=experiment.task_id,
+            tags=tags,
+            metadata=json.dumps(metadata) if isinstance(metadata, dict) else None
+        )
+
         try:
-            self._upsert("run_details", run_details)
+            self._upsert_arrow("run_details", run_details)
         except Exception as e:
             print(f"Failed to log run details due to following error.")
             raise e